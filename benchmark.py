@@ -0,0 +1,493 @@
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dateutil.parser import parse
+
+from records import unix_timestamp
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_python(code, repeat):
+    # Median wall-clock time of a fresh interpreter running `code`
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=REPO_DIR)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def bench_startup(args):
+    repeat = args.repeat or 10
+    print('startup (median of fresh interpreters)')
+    interpreter = time_python('pass', repeat)
+    results = [
+        ('python -c pass', interpreter),
+        ('import download', time_python('import download', repeat)),
+        ('import download + load fixtures (--debug)',
+         time_python('import download, constants; constants.SAMPLE_MATCHES', repeat)),
+    ]
+    for label, seconds in results:
+        print(f'  {label:<45} {seconds * 1000:8.1f} ms  ({(seconds - interpreter) * 1000:+.1f} ms over bare python)')
+
+
+def synthetic_corpus(scale):
+    # `scale` (history entry, match details) pairs built from the fixtures. Replicas get their own match ids
+    # but share the fixture segments, so the corpus costs little memory beyond the fixtures themselves.
+    import constants
+
+    data = constants.SPECIFIC_MATCH_SAMPLE['data']
+    corpus = []
+    for i in range(scale):
+        match_id = str(10 ** 18 + i)
+        summary = constants.SAMPLE_MATCHES[i % len(constants.SAMPLE_MATCHES)]
+        summary = {**summary, 'attributes': {**summary['attributes'], 'id': match_id}}
+        details = {'data': {**data, 'attributes': {**data['attributes'], 'id': match_id}}}
+        corpus.append((summary, details))
+    return corpus
+
+
+def measure(stage, repeat):
+    # Best-of-`repeat` wall time of stage(), then peak traced memory of one more (slower, traced) run
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def report(label, seconds, peak, **counts):
+    rates = '  '.join(f'{count / seconds:>12,.0f} {unit}/s' for unit, count in counts.items())
+    print(f'  {label:<28} {seconds * 1000:9.1f} ms  {rates}  peak {peak / 2 ** 20:7.1f} MiB')
+
+
+def traced_size(build):
+    # Bytes still allocated by build() once it returns
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def bench_ingest(args):
+    import download
+    from records import decode_match
+
+    repeat = args.repeat or 3
+    corpus = synthetic_corpus(args.scale)
+    records = [decode_match(match, details, download.STAT_NAMES) for match, details in corpus]
+
+    team_segments = []
+    for record in records:
+        teams = {}
+        for segment in record.segments:
+            teams.setdefault(segment.placement, []).append(segment)
+        for team in teams.values():
+            roster_mask = download.stat_extractor.roster_mask([segment.player_name for segment in team])
+            roster_flags = download.stat_extractor.flags_for_mask(roster_mask)
+            team_segments.extend((segment, roster_flags) for segment in team)
+
+    rows = [row for record in records for row in download.record_rows(record)]
+    num_segments = len(team_segments)
+    print(f'ingest ({len(corpus):,} matches, {num_segments:,} segments, {len(rows):,} rows, best of {repeat})')
+
+    match, details = corpus[0]
+    raw_json = json.dumps(details)
+
+    def decode_fresh_payload():
+        record = decode_match(match, json.loads(raw_json), download.STAT_NAMES)
+        return record
+
+    raw_size = traced_size(lambda: json.loads(raw_json))
+    record_size = traced_size(decode_fresh_payload)
+    print(f'  memory per match: raw payload {raw_size / 1024:,.0f} KiB, MatchRecord {record_size / 1024:,.0f} KiB')
+
+    def decode():
+        for match, details in corpus:
+            decode_match(match, details, download.STAT_NAMES)
+
+    def extract():
+        for segment, roster_flags in team_segments:
+            download.stat_extractor(segment, roster_flags)
+
+    timestamps = [row[download.COLUMNS.index('match_timestamp')] for row in rows]
+
+    def parse_timestamps_per_row():
+        for timestamp in timestamps:
+            parse(timestr=timestamp).timestamp()
+
+    def decode_timestamps_per_match():
+        for match, _ in corpus:
+            unix_timestamp(match['metadata']['timestamp'])
+
+    def group():
+        for record in records:
+            for _ in download.record_rows(record):
+                pass
+
+    def transform():
+        for match, details in corpus:
+            for _ in download.match_rows(match, details):
+                pass
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'data_file.csv')
+
+        def write_csv():
+            with open(csv_path, 'w') as data_file:
+                row_writer = download.RowWriter(csv.writer(data_file))
+                for row in rows:
+                    row_writer.write(row)
+
+        seconds, peak = measure(decode, repeat)
+        report('decode records', seconds, peak, segments=num_segments)
+        seconds, peak = measure(extract, repeat)
+        report('stat extractor', seconds, peak, segments=num_segments)
+        seconds, peak = measure(parse_timestamps_per_row, repeat)
+        report('timestamps: dateutil per row', seconds, peak, rows=len(timestamps))
+        seconds, peak = measure(decode_timestamps_per_match, repeat)
+        report('timestamps: fast per match', seconds, peak, rows=len(timestamps), matches=len(corpus))
+        seconds, peak = measure(group, repeat)
+        report('record_rows (group+extract)', seconds, peak, segments=num_segments, rows=len(rows))
+        seconds, peak = measure(transform, repeat)
+        report('match_rows (decode+rows)', seconds, peak, segments=num_segments, rows=len(rows))
+        seconds, peak = measure(write_csv, repeat)
+        report('csv writer', seconds, peak, rows=len(rows), bytes=os.path.getsize(csv_path))
+
+
+def varied_payload(details, match_id):
+    # Fresh copy of a fixture payload whose stat values differ from replica to replica, so compression
+    # ratios are not flattered by byte-identical matches
+    payload = json.loads(json.dumps(details))
+    payload['data']['attributes']['id'] = match_id
+    rng = random.Random(match_id)
+    for seg in payload['data']['segments']:
+        for stat in seg['stats'].values():
+            if isinstance(stat['value'], float):
+                stat['value'] = round(stat['value'] * rng.uniform(0.5, 1.5), 2)
+                stat['displayValue'] = f"{stat['value']:,}"
+    return payload
+
+
+def bench_cache(args):
+    import constants
+    from match_store import MatchLogStore, RawArchive, zstandard
+    from records import project_match
+
+    repeat = args.repeat or 3
+    match_ids = [str(10 ** 18 + i) for i in range(args.scale)]
+    archive_codec = 'zstd + trained dictionary' if zstandard is not None else 'zlib, zstandard not installed'
+    print(f'cache ({len(match_ids):,} matches with varied stat values, best of {repeat})')
+
+    def read_all(store_class, path):
+        def read():
+            with store_class(path) as store:
+                for _ in store.items():
+                    pass
+        return read
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, store_class, convert in [
+            ('raw payloads (log store)', MatchLogStore, None),
+            ('projected (log store)', MatchLogStore, project_match),
+            (f'raw archive ({archive_codec})', RawArchive, None),
+        ]:
+            path = os.path.join(tmp_dir, str(len(os.listdir(tmp_dir))))
+            with store_class(path) as store:
+                for match_id in match_ids:
+                    payload = varied_payload(constants.SPECIFIC_MATCH_SAMPLE, match_id)
+                    store[match_id] = convert(payload) if convert else payload
+            seconds, peak = measure(read_all(store_class, path), repeat)
+            size = os.path.getsize(path)
+            print(f'  {label:<48} {size / 2 ** 20:7.1f} MiB  {size / len(match_ids) / 1024:7.1f} KiB/match  '
+                  f'open+read all {seconds * 1000:8.1f} ms  peak {peak / 2 ** 20:6.1f} MiB')
+
+
+def bench_export(args):
+    import download
+    from columnar_export import ParquetPartWriter, have_pyarrow
+
+    if not have_pyarrow():
+        print('export: pyarrow is not installed, skipping')
+        return
+
+    import pyarrow.parquet
+
+    repeat = args.repeat or 3
+    rows = [
+        row
+        for match, details in synthetic_corpus(args.scale)
+        for row in download.match_rows(match, varied_payload(details, match['attributes']['id']))
+    ]
+    print(f'export ({len(rows):,} rows with varied stat values, best of {repeat})')
+    columns = download.COLUMNS
+    types = download.column_registry.types
+    converters = {'str': str, 'int': int, 'float': float}
+    wanted = ['player_name', 'kills']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'data_file.csv')
+        parquet_path = os.path.join(tmp_dir, 'part-00000.parquet')
+
+        def write_csv():
+            with open(csv_path, 'w') as data_file:
+                row_writer = download.RowWriter(csv.writer(data_file))
+                for row in rows:
+                    row_writer.write(row)
+
+        def write_parquet():
+            part_writer = ParquetPartWriter(parquet_path, columns, types)
+            for row in rows:
+                part_writer.write(row)
+            part_writer.close()
+
+        def read_csv():
+            # What a reader has to do to get typed values back: parse every field, then convert it
+            with open(csv_path, newline='') as data_file:
+                reader = csv.reader(data_file)
+                next(reader)
+                convert = [converters[column_type] for column_type in types]
+                for row in reader:
+                    [fn(value) if value else None for fn, value in zip(convert, row)]
+
+        def read_csv_columns():
+            with open(csv_path, newline='') as data_file:
+                reader = csv.reader(data_file)
+                header = next(reader)
+                indexes = [header.index(name) for name in wanted]
+                for row in reader:
+                    row[indexes[0]], float(row[indexes[1]])
+
+        for label, stage in [('write csv', write_csv), ('write parquet', write_parquet)]:
+            seconds, peak = measure(stage, repeat)
+            report(label, seconds, peak, rows=len(rows))
+        print(f'  size: csv {os.path.getsize(csv_path) / 2 ** 20:.2f} MiB, '
+              f'parquet {os.path.getsize(parquet_path) / 2 ** 20:.2f} MiB')
+        for label, stage in [
+            ('read csv, typed', read_csv),
+            ('read parquet', lambda: pyarrow.parquet.read_table(parquet_path)),
+            (f'read csv, {len(wanted)} columns', read_csv_columns),
+            (f'read parquet, {len(wanted)} columns', lambda: pyarrow.parquet.read_table(parquet_path, columns=wanted)),
+        ]:
+            seconds, peak = measure(stage, repeat)
+            report(label, seconds, peak, rows=len(rows))
+
+
+def bench_features(args):
+    import download
+    from feature_matrix import FeatureMatrixWriter, have_numpy
+
+    if not have_numpy():
+        print('features: numpy is not installed, skipping')
+        return
+
+    import numpy
+
+    repeat = args.repeat or 3
+    rows = [
+        row
+        for match, details in synthetic_corpus(args.scale)
+        for row in download.match_rows(match, varied_payload(details, match['attributes']['id']))
+    ]
+    print(f'features ({len(rows):,} rows x {len(download.FEATURE_COLUMNS)} features, best of {repeat})')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, 'data_file.csv')
+        matrix_path = os.path.join(tmp_dir, 'features.npy')
+        index_path = os.path.join(tmp_dir, 'features_index.npy')
+        with open(csv_path, 'w') as data_file:
+            row_writer = download.RowWriter(csv.writer(data_file))
+            for row in rows:
+                row_writer.write(row)
+
+        def write_features():
+            feature_writer = FeatureMatrixWriter(download.COLUMNS, download.FEATURE_COLUMNS,
+                                                 matrix_path=matrix_path, index_path=index_path)
+            for row in rows:
+                feature_writer.write(row)
+            feature_writer.close()
+
+        def matrix_from_csv():
+            # What every consumer used to do: parse the CSV and build the matrix itself
+            with open(csv_path, newline='') as data_file:
+                reader = csv.reader(data_file)
+                header = next(reader)
+                indexes = [header.index(name) for name in download.FEATURE_COLUMNS]
+                matrix = numpy.array([[float(row[i]) if row[i] else numpy.nan for i in indexes] for row in reader],
+                                     dtype='float32')
+            return matrix
+
+        def open_matrix():
+            numpy.load(matrix_path, mmap_mode='r')
+            numpy.load(index_path, mmap_mode='r')
+
+        seconds, peak = measure(write_features, repeat)
+        report('write feature matrix', seconds, peak, rows=len(rows))
+        seconds, peak = measure(matrix_from_csv, repeat)
+        report('build matrix from csv', seconds, peak, rows=len(rows))
+        seconds, peak = measure(open_matrix, repeat)
+        report('open matrix + index (mmap)', seconds, peak, rows=len(rows))
+
+
+def bench_columns(args):
+    import extend_csv
+    from column_registry import ColumnRegistry
+    from feature_matrix import have_numpy
+
+    if not have_numpy():
+        print('columns: numpy is not installed, skipping')
+        return
+
+    repeat = args.repeat or 3
+    registry = ColumnRegistry.load()
+    types = dict(zip(registry.names, registry.types))
+    converters = {'int': int, 'float': float}
+    # complete_data_file.csv repeated `scale` / 2 times (100 at the default scale)
+    with open(os.path.join(REPO_DIR, extend_csv.CSV_FILE), newline='') as csv_file:
+        header, *rows = csv_file.readlines()
+    copies = max(1, args.scale // 2)
+    print(f'columns ({len(rows) * copies:,} rows, {extend_csv.CSV_FILE} x {copies}, best of {repeat})')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_path = os.path.join(tmp_dir, extend_csv.CSV_FILE)
+        with open(csv_path, 'w', newline='') as csv_file:
+            csv_file.write(header)
+            for _ in range(copies):
+                csv_file.writelines(rows)
+
+        def dict_reader():
+            with open(csv_path, newline='') as csv_file:
+                return list(csv.DictReader(csv_file))
+
+        def dict_reader_typed():
+            # The DictReader loop extend_csv.py used to be, converting each field by its registry type
+            typed_rows = []
+            with open(csv_path, newline='') as csv_file:
+                for row in csv.DictReader(csv_file):
+                    typed_rows.append({
+                        name: converters[types[name]](value) if value and types.get(name, 'str') != 'str' else value
+                        for name, value in row.items()
+                    })
+            return typed_rows
+
+        def first_load():
+            shutil.rmtree(csv_path + extend_csv.SIDECAR_SUFFIX, ignore_errors=True)
+            return extend_csv.load_columns(csv_path, registry)
+
+        def sidecar_load():
+            return extend_csv.load_columns(csv_path, registry)
+
+        num_rows = len(rows) * copies
+        for label, stage in [
+            ('csv.DictReader, strings', dict_reader),
+            ('csv.DictReader, typed', dict_reader_typed),
+            ('load_columns, first load', first_load),
+            ('load_columns, memory-mapped', sidecar_load),
+        ]:
+            seconds, peak = measure(stage, repeat)
+            report(label, seconds, peak, rows=num_rows)
+
+
+def bench_roster(args):
+    import download
+    from roster_index import RosterIndex
+
+    repeat = args.repeat or 5
+    # `scale` * 5000 rows (a million by default) drawn from a few dozen squads of one to four roster players
+    rng = random.Random(0)
+    handles = [handle.strip() for handle in download.ROSTER_BIT_HANDLES]
+    squads = sorted({sum(1 << i for i in rng.sample(range(len(handles)), rng.randint(1, 4))) for _ in range(60)})
+    masks = rng.choices(squads, k=args.scale * 5000)
+    new_masks = masks[:300]
+    flags_by_mask = {mask: tuple(mask >> i & 1 for i in range(len(handles))) for mask in squads}
+    rows = [flags_by_mask[mask] for mask in masks]
+    first, second = handles[1], handles[2]
+    print(f'roster ({len(masks):,} rows in {len(squads)} squads, {first} and {second}, best of {repeat})')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = os.path.join(tmp_dir, 'roster_index')
+
+        def build_index():
+            index = RosterIndex(handles, directory)
+            for mask in masks:
+                index.add(mask)
+            index.save()
+
+        def append_run():
+            # A routine run: open the saved index, add a few hundred rows and save it
+            index = RosterIndex.load(directory)
+            for mask in new_masks:
+                index.add(mask)
+            index.save()
+
+        def rows_with():
+            return RosterIndex.load(directory).rows_with(first, second)
+
+        def scan_flags():
+            # What a consumer does without the index: check both has_* flags row by row
+            i, j = handles.index(first), handles.index(second)
+            return [row_id for row_id, flags in enumerate(rows) if flags[i] and flags[j]]
+
+        seconds, peak = measure(build_index, 1)
+        report('build + save index', seconds, peak, rows=len(masks))
+        build_index()
+        seconds, peak = measure(append_run, repeat)
+        report(f'load + append {len(new_masks)} rows', seconds, peak, rows=len(new_masks))
+        build_index()
+        assert rows_with() == scan_flags()
+        found = len(rows_with())
+        seconds, peak = measure(rows_with, repeat)
+        report(f'load + rows_with ({found:,})', seconds, peak, rows=found)
+        seconds, peak = measure(scan_flags, repeat)
+        report('has_* flags row by row', seconds, peak, rows=len(masks))
+
+
+BENCHMARKS = {
+    'cache': bench_cache,
+    'columns': bench_columns,
+    'export': bench_export,
+    'features': bench_features,
+    'ingest': bench_ingest,
+    'roster': bench_roster,
+    'startup': bench_startup,
+}
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Time the download.py pipeline')
+    arg_parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                            help=f'one of {", ".join(sorted(BENCHMARKS))} (default: all)')
+    arg_parser.add_argument('--repeat', type=int, help='timing runs per measurement (default depends on the benchmark)')
+    arg_parser.add_argument('--scale', type=int, default=200,
+                            help='synthetic matches replicated from the fixtures for ingest (default: %(default)s)')
+    args = arg_parser.parse_args(argv)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        arg_parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import json
+import os
+from operator import itemgetter
+
+# The export columns, their types and their order live in columns.json rather than being derived from
+# PLAYER_HANDLES and STAT_NAMES at write time, so reordering either list in the code can't reorder a file.
+# Columns are only ever appended: each one records the registry version that added it, and a file written
+# under one version lines up column for column with every file written under it or under a later version.
+COLUMN_REGISTRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'columns.json')
+COLUMN_TYPES = ('str', 'int', 'float')
+
+
+class ColumnRegistry:
+    def __init__(self, path=COLUMN_REGISTRY_FILE, version=0, columns=()):
+        self.path = path
+        self.version = version
+        # [{'name': ..., 'type': ..., 'since': version}, ...] in file order
+        self.columns = list(columns)
+
+    @classmethod
+    def load(cls, path=COLUMN_REGISTRY_FILE):
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as registry_file:
+            registry = json.load(registry_file)
+        return cls(path, registry['version'], registry['columns'])
+
+    def save(self):
+        # One column per line, so a new version shows up in a diff as the lines it appended
+        columns = ',\n'.join(f'    {json.dumps(column)}' for column in self.columns)
+        with open(self.path + '.tmp', 'w') as registry_file:
+            registry_file.write(f'{{\n  "version": {self.version},\n  "columns": [\n{columns}\n  ]\n}}\n')
+        os.replace(self.path + '.tmp', self.path)
+
+    @property
+    def names(self):
+        return [column['name'] for column in self.columns]
+
+    @property
+    def types(self):
+        return [column['type'] for column in self.columns]
+
+    def register(self, columns, column_type):
+        # Appends the columns this registry doesn't know yet as a new version and returns their names.
+        # Registered columns missing from `columns` stay where they are, since dropping one would shift
+        # every column after it; the writer fills them in as best it can (see retired_columns).
+        known = set(self.names)
+        added = [name for name in columns if name not in known]
+        if added:
+            self.version += 1
+            for name in added:
+                assert column_type(name) in COLUMN_TYPES
+                self.columns.append({'name': name, 'type': column_type(name), 'since': self.version})
+        return added
+
+    def retired_columns(self, columns):
+        # Registered columns that `columns` no longer has, in registry order
+        columns = set(columns)
+        return [name for name in self.names if name not in columns]
+
+    def row_order(self, columns):
+        # Callable reordering a row built in `columns` order into registry order, or None if they already agree
+        names = self.names
+        if list(columns) == names:
+            return None
+        position = {name: i for i, name in enumerate(columns)}
+        return itemgetter(*[position[name] for name in names])
@@ -0,0 +1,153 @@
+import json
+import os
+from datetime import datetime, timezone
+from importlib.util import find_spec
+from urllib.parse import quote, unquote
+
+# Typed, columnar copy of data_file.csv, with column types from columns.json: nullable int64/float64
+# columns instead of repr floats and empty strings, and the repetitive string columns dictionary-encoded.
+# PARQUET_DIR is partitioned hive-style by the match's UTC date and mode,
+#
+#   data_parquet/date=2020-06-01/mode=br_25/part-00003.parquet
+#
+# and each run adds one part to every partition it has rows for. Readers that understand hive partitioning
+# skip whole directories for filters on date and mode, e.g.
+# pandas.read_parquet(PARQUET_DIR, columns=[...], filters=[('mode', '=', 'br_25')]). DATASET_MANIFEST
+# lists the partitions with their files and row counts; its leading underscore keeps dataset readers off it.
+PARQUET_DIR = 'data_parquet'
+DATASET_MANIFEST = '_manifest.json'
+PARQUET_BATCH_ROWS = 10000
+DICTIONARY_COLUMNS = frozenset(['player_name', 'match_modeId', 'match_mapId', 'match_mapName'])
+
+
+def have_pyarrow():
+    # pyarrow takes longer to import than the rest of download.py, so it is only imported once an export
+    # actually writes Parquet
+    return find_spec('pyarrow') is not None
+
+
+def arrow_type(name, column_type):
+    import pyarrow
+    if column_type == 'str':
+        return pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if name in DICTIONARY_COLUMNS \
+            else pyarrow.string()
+    return {'int': pyarrow.int64(), 'float': pyarrow.float64()}[column_type]
+
+
+def arrow_schema(names, types):
+    import pyarrow
+    return pyarrow.schema([(name, arrow_type(name, column_type)) for name, column_type in zip(names, types)])
+
+
+class ParquetPartWriter:
+    # Same write(row) interface as download.RowWriter. Rows are buffered and written out as one row group
+    # per PARQUET_BATCH_ROWS; the part only gets its final name once close() finished it.
+    def __init__(self, path, names, types, batch_rows=PARQUET_BATCH_ROWS):
+        self.path = path
+        self.schema = arrow_schema(names, types)
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.writer = None
+        self.num_rows = 0
+
+    def write(self, row):
+        self.rows.append(row)
+        self.num_rows += 1
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        import pyarrow.parquet
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path + '.tmp', self.schema)
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(zip(*self.rows), self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        # Returns whether a part was written; a run without new rows leaves none behind
+        self.flush()
+        if self.writer is None:
+            return False
+        self.writer.close()
+        os.replace(self.path + '.tmp', self.path)
+        return True
+
+
+def partition_path(unix_timestamp, mode_id):
+    date = datetime.fromtimestamp(unix_timestamp, timezone.utc).date().isoformat()
+    return f'date={date}/mode={quote(mode_id, safe="")}'
+
+
+class PartitionedParquetWriter:
+    # Routes rows to a ParquetPartWriter named `part` in their partition's directory, opened on first use
+    def __init__(self, directory, part, names, types):
+        self.directory = directory
+        self.part = part
+        self.names = names
+        self.types = types
+        self.timestamp_index = names.index('match_unix_timestamp')
+        self.mode_index = names.index('match_modeId')
+        # Keyed on (unix timestamp, mode) so a match's rows look up their partition without formatting a date
+        self.writers_by_key = {}
+        self.writers = {}
+
+    def write(self, row):
+        key = (row[self.timestamp_index], row[self.mode_index])
+        part_writer = self.writers_by_key.get(key)
+        if part_writer is None:
+            path = f'{partition_path(*key)}/{self.part}'
+            part_writer = self.writers.get(path)
+            if part_writer is None:
+                os.makedirs(os.path.join(self.directory, os.path.dirname(path)), exist_ok=True)
+                part_writer = self.writers[path] = ParquetPartWriter(
+                    os.path.join(self.directory, path), self.names, self.types)
+            self.writers_by_key[key] = part_writer
+        part_writer.write(row)
+
+    def close(self):
+        # Returns {path under the dataset directory: rows} of the parts written
+        parts = {}
+        for path, part_writer in self.writers.items():
+            if part_writer.close():
+                parts[path] = part_writer.num_rows
+        return parts
+
+
+def start_parquet_part(directory, parts, names, types):
+    # Removes whatever `parts` ({path: rows}) doesn't list, i.e. parts of an earlier full export or of a run
+    # that never finished, and returns a writer for the next part
+    os.makedirs(directory, exist_ok=True)
+    for dir_path, _, file_names in os.walk(directory, topdown=False):
+        for file_name in file_names:
+            path = os.path.relpath(os.path.join(dir_path, file_name), directory).replace(os.sep, '/')
+            if path not in parts and path != DATASET_MANIFEST:
+                os.remove(os.path.join(dir_path, file_name))
+        if dir_path != directory and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+
+    part_number = max([int(path.rsplit('part-', 1)[1].split('.')[0]) for path in parts], default=-1) + 1
+    return PartitionedParquetWriter(directory, f'part-{part_number:05d}.parquet', names, types)
+
+
+def write_dataset_manifest(directory, parts, column_version):
+    partitions = {}
+    for path, num_rows in sorted(parts.items()):
+        partition, file_name = path.rsplit('/', 1)
+        date, mode = [unquote(key_value.split('=', 1)[1]) for key_value in partition.split('/')]
+        entry = partitions.setdefault(partition, {'date': date, 'mode': mode, 'rows': 0, 'files': []})
+        entry['rows'] += num_rows
+        entry['files'].append(file_name)
+
+    manifest = {
+        'column_version': column_version,
+        'partitioning': ['date', 'mode'],
+        'rows': sum(parts.values()),
+        'partitions': partitions,
+    }
+    path = os.path.join(directory, DATASET_MANIFEST)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(path + '.tmp', path)
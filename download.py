@@ -1,13 +1,25 @@
+import argparse
+import asyncio
 import csv
-import pickle
+import json
+import multiprocessing
+import os
 import time
 import urllib
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 import requests
-from dateutil.parser import parser, parse
+from requests.adapters import HTTPAdapter
 
-from constants import SAMPLE_MATCHES, SPECIFIC_MATCH_SAMPLE
+import constants
+from column_registry import ColumnRegistry
+from columnar_export import PARQUET_DIR, have_pyarrow, start_parquet_part, write_dataset_manifest
+from feature_matrix import FEATURE_INDEX_FILE, FEATURE_MATRIX_FILE, FeatureMatrixWriter, can_append_features, have_numpy
+from match_store import MATCH_STORE_BACKENDS, NegativeCache, RawArchive, compact_raw_archive, open_match_store
+from rate_limiter import TokenBucket
+from roster_index import ROSTER_INDEX_DIR, ROSTER_INDEX_FILE, RosterIndex, RosterIndexWriter
+from records import decode_match, is_projected, project_match, unix_timestamp
 
 PLAYER_HANDLES = [
     'killacure24',
@@ -29,142 +41,757 @@ BATTLENET_IDS = [
     'socom1880#1790',
 ]
 
+# Upper bound on tracker.gg requests in flight at once during a crawl
+MAX_CONCURRENT_REQUESTS = 8
+
+# Keep-alive connections held open to api.tracker.gg; at least one per concurrent request
+HTTP_POOL_SIZE = MAX_CONCURRENT_REQUESTS
+
+
+def make_session(pool_size=HTTP_POOL_SIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    return session
+
+
+session = make_session()
+
+# Requests per second allowed across all callers (paging, detail fetches, workers), and the burst size
+REQUESTS_PER_SECOND = 3
+RATE_LIMIT_BURST = 3
+# How long everyone backs off after a 429 without a Retry-After header
+THROTTLE_PAUSE_SECONDS = 30
+
+MAX_PAGE_ATTEMPTS = 15
+MAX_DETAIL_ATTEMPTS = 8
+MAX_UNEXPECTED_ERROR_ATTEMPTS = 3
+# A request that fails with an error (5xx, connection error) sleeps before its next attempt, on top of the
+# rate limiter, starting at ERROR_BACKOFF_SECONDS and growing ERROR_BACKOFF_FACTOR times per failure
+ERROR_BACKOFF_SECONDS = 2
+ERROR_BACKOFF_FACTOR = 2
+MAX_ERROR_BACKOFF_SECONDS = 120
+
+# Newest match already ingested for each battlenet ID, so later runs stop paging once they reach it
+WATERMARKS_FILE = 'watermarks.json'
+
+# Where match details are cached: 'log' (append-only file) or 'sqlite' (indexed, queryable).
+# A new store imports whichever older cache it finds first.
+MATCH_STORE_BACKEND = 'log'
+MATCH_STORE_FILES = {
+    'log': 'saved_matches.log',
+    'sqlite': 'saved_matches.sqlite',
+}
+LEGACY_MATCH_CACHE_FILE = 'saved_matches.p'
+
+# 'raw' caches tracker.gg's full response; 'projected' caches only the stat values (records.project_match),
+# about a seventh of the size, in separate store files. When ARCHIVE_RAW_PAYLOADS is on, projected ingest
+# keeps the full responses in compressed cold storage in RAW_ARCHIVE_FILE (zstd with a dictionary trained
+# on the archive itself when the zstandard package is installed, zlib otherwise).
+INGEST_MODE = 'raw'
+ARCHIVE_RAW_PAYLOADS = True
+RAW_ARCHIVE_FILE = 'raw_matches.archive'
+
+# Failed detail lookups wait FAILED_MATCH_RETRY_SECONDS (doubling per failure) before a later run
+# retries them, and are given up on after MAX_MATCH_LOOKUP_ATTEMPTS failures
+FAILED_MATCHES_FILE = 'failed_matches.json'
+FAILED_MATCH_RETRY_SECONDS = 6 * 60 * 60
+MAX_MATCH_LOOKUP_ATTEMPTS = 5
+
+# data_file.csv is appended to from run to run. The export manifest records the columns.json version it was
+# written with, its size after the last complete export and every match id exported so far, so a run only
+# writes rows for new matches. Anything past the recorded size was appended by a run that didn't finish and
+# is cut off.
+DATA_FILE = 'data_file.csv'
+EXPORT_MANIFEST_FILE = 'export_manifest.json'
+# --debug runs export the fixtures here instead, leaving the real export and its manifest untouched
+DEBUG_EXPORT_DIR = 'debug_export'
+
+# Also export each run's rows to the typed Parquet dataset in PARQUET_DIR, partitioned by match date and mode
+# (columnar_export.py; needs pyarrow)
+EXPORT_PARQUET = True
+# Also append them to the float32 feature matrix in FEATURE_MATRIX_FILE (feature_matrix.py; needs numpy)
+EXPORT_FEATURES = True
+
+rate_limiter = TokenBucket(REQUESTS_PER_SECOND, RATE_LIMIT_BURST)
+
+
+def retry_after_seconds(response):
+    try:
+        return float(response.headers.get('Retry-After', THROTTLE_PAUSE_SECONDS))
+    except ValueError:
+        return THROTTLE_PAUSE_SECONDS
+
+
+def error_backoff(url, backoff):
+    # Sleeps this request's current backoff and returns the next one
+    print(f'Retrying {url} in {backoff} seconds...')
+    time.sleep(backoff)
+    return min(backoff * ERROR_BACKOFF_FACTOR, MAX_ERROR_BACKOFF_SECONDS)
+
+
 def make_api_request(url, big_timeout=False):
-    to_sleep = 10
-    while True:
+    max_attempts = MAX_PAGE_ATTEMPTS if big_timeout else MAX_DETAIL_ATTEMPTS
+    backoff = ERROR_BACKOFF_SECONDS
+    for attempt in range(1, max_attempts + 1):
+        rate_limiter.acquire()
         try:
             print(f'Attempting to get {url}...')
-            response = requests.get(url)
-            if response.status_code != 200:
-                err_text = str(response.text)
-                print(err_text)
-                if 'An unexpected error occured in our system' in err_text and to_sleep > 60:
-                    return None
-                if not big_timeout and to_sleep > 600:
-                    return None
-                if to_sleep > 2000:
-                    return None
-
-                raise Exception('non 200')
-
-            response_json = response.json()
-            return response_json
+            response = session.get(url)
+            if response.status_code == 200:
+                return response.json()
         except Exception as e:
             print(f'Failed: {e}')
-            print(f'Sleeping {to_sleep} seconds...')
-            time.sleep(to_sleep)
-            to_sleep *= 1.4
+            if attempt < max_attempts:
+                backoff = error_backoff(url, backoff)
+            continue
+
+        err_text = str(response.text)
+        print(err_text)
+        if response.status_code == 429:
+            # Throttling is shared by every caller, so it pauses the limiter rather than just this request
+            pause = retry_after_seconds(response)
+            print(f'Throttled, pausing all requests for {pause} seconds...')
+            rate_limiter.pause(pause)
+            continue
+        if 'An unexpected error occured in our system' in err_text and attempt >= MAX_UNEXPECTED_ERROR_ATTEMPTS:
+            return None
+        if attempt < max_attempts:
+            backoff = error_backoff(url, backoff)
+
+    return None
+
+
+def match_details_url(match_id):
+    #   https://api.tracker.gg/api/v1/warzone/matches/8986566823157720677
+    return f'https://api.tracker.gg/api/v1/warzone/matches/{match_id}'
 
 
-def get_specific_match_details(match_id):
-    if DEBUG:
-        return SPECIFIC_MATCH_SAMPLE
+def match_store_path(backend, ingest_mode):
+    path = MATCH_STORE_FILES[backend]
+    if ingest_mode == 'projected':
+        root, ext = os.path.splitext(path)
+        path = f'{root}.projected{ext}'
+    return path
+
+
+def match_store_sources(backend, ingest_mode):
+    # Older caches a new store imports from, best first; a projected cache can't be turned back into raw
+    modes = ['raw'] if ingest_mode == 'raw' else ['projected', 'raw']
+    sources = [match_store_path(other_backend, mode) for mode in modes for other_backend in sorted(MATCH_STORE_FILES)]
+    sources.remove(match_store_path(backend, ingest_mode))
+    return sources + [LEGACY_MATCH_CACHE_FILE]
 
-    #   https://api.tracker.gg/api/v1/warzone/matches/8986566823157720677
-    if match_id in saved_matches:
-        return saved_matches[match_id]
 
-    match_json = make_api_request(f'https://api.tracker.gg/api/v1/warzone/matches/{match_id}')
-    saved_matches[match_id] = match_json
+def cached_form(match_id, match_json):
+    if INGEST_MODE != 'projected' or is_projected(match_json):
+        return match_json
+    if raw_archive is not None:
+        raw_archive[match_id] = match_json
+    return project_match(match_json)
 
-    with open("saved_matches.p", "wb") as load_file:
-        pickle.dump(saved_matches, load_file)
 
+def save_match_details(match_id, match_json):
+    if match_json is None:
+        failed_matches.record_failure(match_id)
+        return
+    failed_matches.record_success(match_id)
+    saved_matches[match_id] = cached_form(match_id, match_json)
+
+
+async def get_specific_match_details_async(match_id, executor):
+    if DEBUG:
+        return constants.SPECIFIC_MATCH_SAMPLE
+
+    match_json = saved_matches.get(match_id)
+    if match_json is not None or failed_matches.should_skip(match_id):
+        return match_json
+
+    loop = asyncio.get_event_loop()
+    match_json = await loop.run_in_executor(executor, make_api_request, match_details_url(match_id))
+    # Back on the event loop thread, so cache writes never race each other
+    save_match_details(match_id, match_json)
     return match_json
 
-def matches_for_player(battlenet_id):
+
+def player_matches_url(battlenet_id, next):
+    encoded_name = urllib.parse.quote(battlenet_id.lower())
+    return f'https://api.tracker.gg/api/v1/warzone/matches/battlenet/{encoded_name}?type=wz&next={next}'
+
+
+def next_page_cursor(response_json):
+    next = response_json['data']['metadata']['next']
+    if not isinstance(next, int) or next < 10000000:
+        return None
+    return next
+
+
+def match_watermark(match):
+    return {
+        'match_id': match['attributes']['id'],
+        'timestamp': unix_timestamp(match['metadata']['timestamp']),
+    }
+
+
+def is_known_match(match, watermark):
+    # Histories come back newest first, so everything from the watermark on was ingested already
+    if watermark is None:
+        return False
+    mark = match_watermark(match)
+    return mark['match_id'] == watermark['match_id'] or mark['timestamp'] < watermark['timestamp']
+
+
+def load_watermarks():
+    if not os.path.exists(WATERMARKS_FILE):
+        return {}
+    with open(WATERMARKS_FILE) as watermarks_file:
+        return json.load(watermarks_file)
+
+
+def save_watermarks(watermarks):
+    with open(WATERMARKS_FILE + '.tmp', 'w') as watermarks_file:
+        json.dump(watermarks, watermarks_file, indent=2, sort_keys=True)
+    os.replace(WATERMARKS_FILE + '.tmp', WATERMARKS_FILE)
+
+
+def load_export_manifest():
+    if not os.path.exists(EXPORT_MANIFEST_FILE):
+        return None
+    with open(EXPORT_MANIFEST_FILE) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_export_manifest(manifest):
+    with open(EXPORT_MANIFEST_FILE + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(EXPORT_MANIFEST_FILE + '.tmp', EXPORT_MANIFEST_FILE)
+
+
+async def fetch_match_page(battlenet_id, next, executor):
     if DEBUG:
-        for m in SAMPLE_MATCHES:
-            yield m
-        return
+        return constants.SAMPLE_MATCHES, None
+
+    loop = asyncio.get_event_loop()
+    response_json = await loop.run_in_executor(
+        executor, make_api_request, player_matches_url(battlenet_id, next), True)
+    if response_json is None:
+        return None, None
+    return response_json['data']['matches'], next_page_cursor(response_json)
+
+
+STAT_NAMES = [
+    'kills', 'kdRatio', 'score', 'timePlayed', 'headshots', 'executions', 'assists', 'percentTimeMoving',
+    'longestStreak', 'scorePerMinute', 'damageDone', 'distanceTraveled', 'deaths', 'damageTaken',
+    'damageDonePerMinute', 'medalXp', 'objectiveTeamWiped', 'objectiveLastStandKill', 'matchXp', 'scoreXp',
+    'totalXp', 'challengeXp', 'objectiveDestroyedVehicleMedium', 'teamSurvivalTime', 'objectiveBrDownEnemyCircle3',
+    'objectiveBrDownEnemyCircle1', 'objectiveBrMissionPickupTablet', 'bonusXp', 'objectiveReviver',
+    'objectiveBrKioskBuy', 'objectiveBrDownEnemyCircle6', 'gulagDeaths', 'gulagKills', 'objectiveBrCacheOpen',
+    'miscXp',
+]
+
+MATCH_COLUMNS = [
+    'team_size', 'match_id', 'match_timestamp', 'match_unix_timestamp', 'match_modeId', 'match_mapId',
+    'match_duration', 'match_playerCount', 'match_teamCount', 'match_mapName',
+]
+
 
+class StatExtractor:
+    # Built once from the column schema. Roster flags are derived from a bitmask of the
+    # team's roster members and cached per mask, so they are computed once per team
+    # rather than by scanning PLAYER_HANDLES for every segment, and decoded segments are
+    # turned straight into row tuples without an intermediate dict.
+    def __init__(self, stat_names, player_handles):
+        self.stat_names = tuple(stat_names)
+        self.roster_bits = {handle: 1 << i for i, handle in enumerate(player_handles)}
+        self.flags_by_mask = {}
+        self.columns = ['player_name', 'placement'] + ['has_' + handle.strip() for handle in player_handles] \
+            + list(stat_names)
+
+    def roster_mask(self, team_members):
+        mask = 0
+        for member in team_members:
+            mask |= self.roster_bits.get(member, 0)
+        return mask
+
+    def flags_for_mask(self, mask):
+        flags = self.flags_by_mask.get(mask)
+        if flags is None:
+            flags = self.flags_by_mask[mask] = tuple(1 if mask & bit else 0 for bit in self.roster_bits.values())
+        return flags
+
+    def __call__(self, segment, roster_flags):
+        # `segment` is a SegmentRecord decoded for self.stat_names
+        return (segment.player_name, segment.placement) + roster_flags + segment.stats
+
+
+ROSTER_HANDLES = frozenset(PLAYER_HANDLES)
+
+MATCH_COLUMN_TYPES = {
+    'team_size': 'int', 'match_id': 'str', 'match_timestamp': 'str', 'match_unix_timestamp': 'float',
+    'match_modeId': 'str', 'match_mapId': 'str', 'match_duration': 'float', 'match_playerCount': 'int',
+    'match_teamCount': 'int', 'match_mapName': 'str',
+}
+
+
+def column_type(name):
+    if name in MATCH_COLUMN_TYPES:
+        return MATCH_COLUMN_TYPES[name]
+    if name == 'player_name':
+        return 'str'
+    if name in ('placement', 'roster_mask') or name.startswith('has_'):
+        return 'int'
+    return 'float'
+
+
+# Columns new to columns.json (a new handle or stat) are appended to it as a new version; main() saves it
+column_registry = ColumnRegistry.load()
+NEW_COLUMNS = column_registry.register(
+    StatExtractor(STAT_NAMES, PLAYER_HANDLES).columns + MATCH_COLUMNS + ['roster_mask'], column_type)
+COLUMNS = column_registry.names
+
+# Bit i of a row's roster_mask is the i-th has_* column in columns.json, so a mask means the same squad in
+# every export however PLAYER_HANDLES gets reordered (roster_index.py). A handle since dropped from
+# PLAYER_HANDLES keeps its bit and its has_* column, and is still flagged on the roster's teams it joins.
+HANDLES_BY_FLAG = {'has_' + handle.strip(): handle for handle in PLAYER_HANDLES}
+ROSTER_BIT_HANDLES = [HANDLES_BY_FLAG.get(name, name[len('has_'):]) for name in COLUMNS if name.startswith('has_')]
+stat_extractor = StatExtractor(STAT_NAMES, ROSTER_BIT_HANDLES)
+# Registered columns nothing builds any more, e.g. a stat dropped from STAT_NAMES; written empty
+RETIRED_COLUMNS = column_registry.retired_columns(stat_extractor.columns + MATCH_COLUMNS + ['roster_mask'])
+RETIRED_FIELDS = (None,) * len(RETIRED_COLUMNS)
+# The order record_rows builds rows in; files are written in columns.json order (column_registry.py)
+ROW_COLUMNS = stat_extractor.columns + MATCH_COLUMNS + ['roster_mask'] + RETIRED_COLUMNS
+reorder_row = column_registry.row_order(ROW_COLUMNS)
+# The feature matrix columns (feature_matrix.py), in registry order: the has_* flags and every stat
+FEATURE_COLUMNS = [name for name in COLUMNS if name.startswith('has_')
+                   or column_type(name) == 'float' and name not in MATCH_COLUMN_TYPES]
+
+
+def roster_teams(segments):
+    # One pass over the lobby: bucket segments by placement, remembering which buckets hold a roster player
+    teams = {}
+    roster_placements = set()
+    for segment in segments:
+        teams.setdefault(segment.placement, []).append(segment)
+        if segment.handle in ROSTER_HANDLES:
+            roster_placements.add(segment.placement)
+    return {placement: teams[placement] for placement in roster_placements}
+
+
+def record_rows(record):
+    # Every row of a match shares its match-level columns (MATCH_COLUMNS after team_size), and every row of
+    # a team its team_size and roster_mask
+    fields = (record.match_id, record.timestamp, record.unix_timestamp, record.mode_id, record.map_id,
+              record.duration, record.player_count, record.team_count, record.map_name)
+    for team_segments in roster_teams(record.segments).values():
+        team_members = [segment.player_name for segment in team_segments]
+        roster_mask = stat_extractor.roster_mask(team_members)
+        roster_flags = stat_extractor.flags_for_mask(roster_mask)
+        team_fields = (len(team_members),) + fields + (roster_mask,) + RETIRED_FIELDS
+        for segment in team_segments:
+            row = stat_extractor(segment, roster_flags) + team_fields
+            yield row if reorder_row is None else reorder_row(row)
+
+
+def match_rows(match, match_details):
+    # Only the roster's teams produce rows, so the rest of the lobby is never decoded
+    return record_rows(decode_match(match, match_details, STAT_NAMES, ROSTER_HANDLES))
+
+
+class RowWriter:
+    def __init__(self, csv_writer, columns=COLUMNS, has_written_header=False):
+        self.csv_writer = csv_writer
+        self.columns = columns
+        self.has_written_header = has_written_header
+
+    def write(self, row):
+        if not self.has_written_header:
+            self.csv_writer.writerow(self.columns)
+            self.has_written_header = True
+
+        assert len(row) == len(self.columns)
+        self.csv_writer.writerow(row)
+
+
+class TeeWriter:
+    # Hands every row to each of `row_writers`
+    def __init__(self, *row_writers):
+        self.row_writers = row_writers
+
+    def write(self, row):
+        for row_writer in self.row_writers:
+            row_writer.write(row)
+
+
+class Export:
+    # data_file.csv and its roster index plus, when enabled, the Parquet dataset and the feature matrix, all
+    # written from the same rows by row_writer. Appends to what `manifest` describes if it still matches the files on disk,
+    # otherwise starts everything over. exported_match_ids is what the crawl adds newly exported matches to.
+    # Every file lives under `directory`, the working directory by default.
+    def __init__(self, manifest, parquet=EXPORT_PARQUET, features=EXPORT_FEATURES, directory=''):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if manifest is None or not self.can_append(manifest, parquet, features, directory):
+            manifest = {}
+
+        data_path = os.path.join(directory, DATA_FILE)
+        if manifest:
+            os.truncate(data_path, manifest['size'])
+        self.data_file = open(data_path, 'a' if manifest else 'w')
+        self.exported_match_ids = set(manifest.get('match_ids', ()))
+        row_writers = [RowWriter(csv.writer(self.data_file), has_written_header=self.data_file.tell() > 0)]
+
+        roster_index_dir = os.path.join(directory, ROSTER_INDEX_DIR)
+        if manifest:
+            self.roster_index = RosterIndex.load(roster_index_dir)
+            self.roster_index.truncate(manifest['rows'])
+        else:
+            self.roster_index = RosterIndex([handle.strip() for handle in ROSTER_BIT_HANDLES], roster_index_dir)
+        row_writers.append(RosterIndexWriter(self.roster_index, COLUMNS.index('roster_mask')))
+
+        self.parquet_parts = None
+        self.part_writer = None
+        if parquet:
+            self.parquet_parts = manifest.get('parquet_parts', {})
+            self.part_writer = start_parquet_part(os.path.join(directory, PARQUET_DIR), self.parquet_parts, COLUMNS,
+                                                  column_registry.types)
+            row_writers.append(self.part_writer)
+
+        self.feature_writer = None
+        if features:
+            self.feature_writer = FeatureMatrixWriter(COLUMNS, FEATURE_COLUMNS, manifest.get('feature_rows', 0),
+                                                      os.path.join(directory, FEATURE_MATRIX_FILE),
+                                                      os.path.join(directory, FEATURE_INDEX_FILE))
+            row_writers.append(self.feature_writer)
+
+        self.row_writer = row_writers[0] if len(row_writers) == 1 else TeeWriter(*row_writers)
+
+    @staticmethod
+    def can_append(manifest, parquet, features, directory=''):
+        # False after columns were added to the registry, when a file was replaced, or when the last run
+        # didn't keep one of the enabled outputs up to date
+        data_path = os.path.join(directory, DATA_FILE)
+        if manifest.get('column_version') != column_registry.version:
+            return False
+        if not os.path.exists(data_path) or os.path.getsize(data_path) < manifest['size']:
+            return False
+        if manifest.get('rows') is None or not os.path.exists(os.path.join(directory, ROSTER_INDEX_FILE)):
+            return False
+        if parquet and not isinstance(manifest.get('parquet_parts'), dict):
+            return False
+        if features and (manifest.get('feature_rows') is None or not can_append_features(
+                manifest['feature_rows'], os.path.join(directory, FEATURE_MATRIX_FILE),
+                os.path.join(directory, FEATURE_INDEX_FILE))):
+            return False
+        return True
+
+    def close(self):
+        # Returns the manifest of the export; outputs this run didn't write are None in it
+        manifest = {
+            'column_version': column_registry.version,
+            'size': self.data_file.tell(),
+            'match_ids': sorted(self.exported_match_ids),
+            'rows': self.roster_index.num_rows,
+            'parquet_parts': None,
+            'feature_rows': None,
+        }
+        self.data_file.close()
+        self.roster_index.save()
+        if self.part_writer is not None:
+            self.parquet_parts.update(self.part_writer.close())
+            write_dataset_manifest(os.path.join(self.directory, PARQUET_DIR), self.parquet_parts,
+                                   column_registry.version)
+            manifest['parquet_parts'] = self.parquet_parts
+        if self.feature_writer is not None:
+            manifest['feature_rows'] = self.feature_writer.close()
+        return manifest
+
+
+async def claim_player_matches(battlenet_id, executor, claimed_match_ids, fetch_queue, watermark=None):
+    # Returns the player's new watermark, or the old one if paging gave up before reaching known matches
+    newest = None
     next = 'null'
-    encoded_name = urllib.parse.quote(battlenet_id.lower())
     while next:
-        response_json = make_api_request(f'https://api.tracker.gg/api/v1/warzone/matches/battlenet/{encoded_name}?type=wz&next={next}', big_timeout=True)
-        if response_json is None:
+        matches, next = await fetch_match_page(battlenet_id, next, executor)
+        if matches is None:
+            print(f'Could not page the full history of {battlenet_id}, keeping its old watermark')
+            return watermark
+
+        for match in matches:
+            if newest is None:
+                newest = match_watermark(match)
+            if is_known_match(match, watermark):
+                return newest
+
+            match_id = match['attributes']['id']
+            # Players share squads, so the first pager to see a match owns it
+            if match_id in claimed_match_ids:
+                continue
+            claimed_match_ids.add(match_id)
+            await fetch_queue.put((match_id, match))
+
+    return newest or watermark
+
+
+# The crawl runs as a pipeline of stages joined by bounded queues:
+#
+#   feed_matches -> fetch_queue -> fetch_details (x concurrency) -> decode_queue -> decode_matches
+#                -> transform_queue -> transform_records -> sink_queue -> write_rows
+#
+# Network calls run in the executor's threads while decoding and row building run on the event
+# loop, so I/O and CPU work overlap. A full queue makes its producer wait, so memory stays bounded
+# however far ahead paging and fetching get. None marks the end of a queue's input.
+PIPELINE_QUEUE_SIZE = 64
+
+
+async def feed_matches(executor, watermarks, claimed_match_ids, fetch_queue, decode_queue, num_fetchers):
+    # Every player's `next` cursor chain is independent, so page them all at once
+    new_watermarks = await asyncio.gather(*[
+        claim_player_matches(battlenet_id, executor, claimed_match_ids, fetch_queue, watermarks.get(battlenet_id))
+        for battlenet_id in BATTLENET_IDS
+    ])
+
+    # Failed lookups behind the watermarks are never paged again, so the ones due for a retry are fed here
+    for match_id in failed_matches.due():
+        if match_id not in claimed_match_ids:
+            claimed_match_ids.add(match_id)
+            await fetch_queue.put((match_id, None))
+
+    for _ in range(num_fetchers):
+        await fetch_queue.put(None)
+
+    if not DEBUG:
+        # Matches behind the watermarks were not paged this run; their cached details carry the same
+        # attributes and metadata as a history entry, so they are exported from the cache directly
+        for match_id in [match_id for match_id in saved_matches.keys() if match_id not in claimed_match_ids]:
+            match_details = saved_matches[match_id]
+            if match_details is not None:
+                await decode_queue.put((match_details['data'], match_details))
+
+    await decode_queue.put(None)
+    return {
+        battlenet_id: watermark
+        for battlenet_id, watermark in zip(BATTLENET_IDS, new_watermarks)
+        if watermark is not None
+    }
+
+
+async def fetch_details(executor, fetch_queue, decode_queue):
+    while True:
+        item = await fetch_queue.get()
+        if item is None:
+            await decode_queue.put(None)
             return
 
-        next = response_json['data']['metadata']['next']
-        for m in response_json['data']['matches']:
-            yield m
+        match_id, match = item
+        match_details = await get_specific_match_details_async(match_id, executor)
+        if match_details is not None:
+            await decode_queue.put((match or match_details['data'], match_details))
+
+
+async def decode_matches(decode_queue, transform_queue, num_producers):
+    while num_producers:
+        item = await decode_queue.get()
+        if item is None:
+            num_producers -= 1
+            continue
 
-        if not isinstance(next, int) or next < 10000000:
+        match, match_details = item
+        await transform_queue.put(decode_match(match, match_details, STAT_NAMES, ROSTER_HANDLES))
+
+    await transform_queue.put(None)
+
+
+async def transform_records(transform_queue, sink_queue):
+    while True:
+        record = await transform_queue.get()
+        if record is None:
+            await sink_queue.put(None)
             return
 
-def extract_stats_from_segment(seg, team_members):
-    player_name = seg['attributes']['platformUserIdentifier']
-    stats = {'player_name': player_name, 'placement': seg['metadata']['placement']['value']}
-    for p_name in PLAYER_HANDLES:
-        stats['has_'+p_name.strip()] = 1 if p_name in team_members else 0
-
-    # for stat_name in ['kills', 'kdRatio', 'score', 'timePlayed', 'headshots', 'executions', 'assists', 'percentTimeMoving', 'longestStreak', 'scorePerMinute', 'damageDone', 'distanceTraveled', 'deaths', 'damageTaken', 'damageDonePerMinute']:
-    # for stat_name, stat_dict in seg['stats'].items():
-    for stat_name in ['kills', 'kdRatio', 'score', 'timePlayed', 'headshots', 'executions', 'assists', 'percentTimeMoving', 'longestStreak', 'scorePerMinute', 'damageDone', 'distanceTraveled', 'deaths', 'damageTaken', 'damageDonePerMinute', 'medalXp', 'objectiveTeamWiped', 'objectiveLastStandKill', 'matchXp', 'scoreXp', 'totalXp', 'challengeXp', 'objectiveDestroyedVehicleMedium', 'teamSurvivalTime', 'objectiveBrDownEnemyCircle3', 'objectiveBrDownEnemyCircle1', 'objectiveBrMissionPickupTablet', 'bonusXp', 'objectiveReviver', 'objectiveBrKioskBuy', 'objectiveBrDownEnemyCircle6', 'gulagDeaths', 'gulagKills', 'objectiveBrCacheOpen', 'miscXp']:
-        if stat_name not in seg['stats']:
-            stats[stat_name] = None
-        else:
-            stats[stat_name] = seg['stats'][stat_name]['value']
-            # display_stat_name = stat_dict['displayName']
-            # stats[display_stat_name] = stat_dict['value']
+        await sink_queue.put((record.match_id, list(record_rows(record))))
 
-    return stats
 
+async def write_rows(sink_queue, row_writer, exported_match_ids):
+    while True:
+        item = await sink_queue.get()
+        if item is None:
+            return
 
-already_seen_match_ids = set()
+        match_id, rows = item
+        for row in rows:
+            row_writer.write(row)
+        exported_match_ids.add(match_id)
+
+
+async def crawl(row_writer, watermarks, exported_match_ids=None, concurrency=MAX_CONCURRENT_REQUESTS,
+                queue_size=PIPELINE_QUEUE_SIZE):
+    # Exported matches count as claimed, so they are neither fetched nor read back from the cache.
+    # exported_match_ids gains every match written this run.
+    if exported_match_ids is None:
+        exported_match_ids = set()
+    claimed_match_ids = set(exported_match_ids)
+    fetch_queue = asyncio.Queue(maxsize=queue_size)
+    decode_queue = asyncio.Queue(maxsize=queue_size)
+    transform_queue = asyncio.Queue(maxsize=queue_size)
+    sink_queue = asyncio.Queue(maxsize=queue_size)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        stages = [asyncio.ensure_future(stage) for stage in [
+            feed_matches(executor, watermarks, claimed_match_ids, fetch_queue, decode_queue, concurrency),
+            *[fetch_details(executor, fetch_queue, decode_queue) for _ in range(concurrency)],
+            # Every fetcher plus feed_matches itself put matches on decode_queue
+            decode_matches(decode_queue, transform_queue, concurrency + 1),
+            transform_records(transform_queue, sink_queue),
+            write_rows(sink_queue, row_writer, exported_match_ids),
+        ]]
+        try:
+            new_watermarks, *_ = await asyncio.gather(*stages)
+        except BaseException:
+            # One stage failing would leave the others waiting on its queue forever
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
 
-saved_matches = dict()
-with open("saved_matches.p", "rb") as load_file:
-    saved_matches = pickle.load(load_file)
+    return new_watermarks
 
 
-with open('data_file.csv', 'w') as data_file:
-    csv_writer = csv.writer(data_file)
-    has_written_header = False
-    num_columns = None
+# --rebuild regenerates data_file.csv from the match cache alone, e.g. after STAT_NAMES changed. Match ids are
+# cut into shards of REBUILD_SHARD_SIZE that a process pool transforms in parallel, each worker reading the
+# store itself.
+REBUILD_SHARD_SIZE = 100
 
-    for battlenet_id in BATTLENET_IDS:
-        for match in matches_for_player(battlenet_id):
-            match_id = match['attributes']['id']
-            if match_id in already_seen_match_ids:
-                continue
-            already_seen_match_ids.add(match_id)
+rebuild_store = None
 
-            match_details = get_specific_match_details(match_id)
-            if match_details is None:
-                continue
 
-            segments = match_details['data']['segments']
-            placements = set()
-            for seg in segments:
-                if seg['metadata']['platformUserHandle'] in PLAYER_HANDLES:
-                    placements.add(seg['metadata']['placement']['value'])
-            for placement in placements:
-                team_segments = [seg for seg in segments if seg['metadata']['placement']['value'] == placement]
-                team_members = [seg['attributes']['platformUserIdentifier'] for seg in team_segments]
-                for seg in team_segments:
-                    timestamp = match['metadata']['timestamp']
-                    stats = {
-                        **extract_stats_from_segment(seg, team_members),
-                        'team_size': len(team_members),
-                        'match_id': match['attributes']['id'],
-                        'match_timestamp': timestamp,
-                        'match_unix_timestamp': parse(timestr=timestamp).timestamp(),
-                        'match_modeId': match['attributes']['modeId'],
-                        'match_mapId': match['attributes']['mapId'],
-                        'match_duration': match['metadata']['duration']['value'] / 1000,
-                        'match_playerCount': match['metadata']['playerCount'],
-                        'match_teamCount': match['metadata']['teamCount'],
-                        'match_mapName': match['metadata']['mapName'],
-                    }
-
-                    if not has_written_header:
-                        csv_writer.writerow(stats.keys())
-                        has_written_header = True
-
-                    if not num_columns:
-                        num_columns = len(stats)
-                    else:
-                        assert num_columns == len(stats)
-
-                    csv_writer.writerow(stats.values())
+def open_rebuild_store(store_path, backend):
+    global rebuild_store
+    rebuild_store = MATCH_STORE_BACKENDS[backend](store_path)
+
+
+def rebuild_shard(match_ids):
+    rows = []
+    for match_id in match_ids:
+        match_details = rebuild_store.get(match_id)
+        if match_details is not None:
+            rows.extend(record_rows(decode_match(match_details['data'], match_details, STAT_NAMES, ROSTER_HANDLES)))
+    return rows
+
+
+def rebuild_csv(store_path, backend, row_writer, workers=None, shard_size=REBUILD_SHARD_SIZE):
+    with MATCH_STORE_BACKENDS[backend](store_path) as store:
+        match_ids = sorted(store.keys())
+    shards = [match_ids[i:i + shard_size] for i in range(0, len(match_ids), shard_size)]
+
+    with multiprocessing.Pool(workers, initializer=open_rebuild_store, initargs=(store_path, backend)) as pool:
+        # imap hands shards back in submission order, so the output doesn't depend on the worker count
+        for rows in pool.imap(rebuild_shard, shards):
+            for row in rows:
+                row_writer.write(row)
+
+    return match_ids
+
+
+# Opened by main(); in-memory until then so the helpers above stay usable on their own
+saved_matches = dict()
+failed_matches = NegativeCache()
+raw_archive = None
+
+
+def main(argv=None):
+    global DEBUG, INGEST_MODE, saved_matches, failed_matches, raw_archive
+    arg_parser = argparse.ArgumentParser(description='Download Warzone match stats from tracker.gg into data_file.csv')
+    arg_parser.add_argument('--debug', action='store_true',
+                            help=f'replay the sample payloads in fixtures.json instead of calling tracker.gg, '
+                                 f'exporting them to {DEBUG_EXPORT_DIR}/')
+    arg_parser.add_argument('--full-crawl', action='store_true',
+                            help='ignore the per-player watermarks and page every history from the start')
+    arg_parser.add_argument('--store', choices=sorted(MATCH_STORE_FILES), default=MATCH_STORE_BACKEND,
+                            help='match cache backend (default: %(default)s)')
+    arg_parser.add_argument('--ingest', choices=['raw', 'projected'], default=INGEST_MODE,
+                            help='cache full responses or only their stat values (default: %(default)s)')
+    arg_parser.add_argument('--no-raw-archive', dest='archive_raw', action='store_false', default=ARCHIVE_RAW_PAYLOADS,
+                            help='with --ingest projected, drop raw responses instead of archiving them')
+    arg_parser.add_argument('--full-export', action='store_true',
+                            help=f'rewrite {DATA_FILE} from scratch instead of appending rows for new matches only')
+    arg_parser.add_argument('--no-parquet', dest='parquet', action='store_false', default=EXPORT_PARQUET,
+                            help=f'don\'t write the Parquet dataset in {PARQUET_DIR}')
+    arg_parser.add_argument('--no-features', dest='features', action='store_false', default=EXPORT_FEATURES,
+                            help=f'don\'t write the feature matrix {FEATURE_MATRIX_FILE}')
+    arg_parser.add_argument('--rebuild', action='store_true',
+                            help='regenerate data_file.csv from the match cache only, without calling tracker.gg')
+    arg_parser.add_argument('--workers', type=int, default=None,
+                            help='processes used by --rebuild (default: one per CPU)')
+    arg_parser.add_argument('--compact-raw-archive', action='store_true',
+                            help=f'retrain the {RAW_ARCHIVE_FILE} compression dictionary on its contents, rewrite it, and exit')
+    args = arg_parser.parse_args(argv)
+
+    if args.compact_raw_archive:
+        compact_raw_archive(RAW_ARCHIVE_FILE)
+        return
+
+    if NEW_COLUMNS:
+        column_registry.save()
+        print(f'Added {", ".join(NEW_COLUMNS)} to {column_registry.path} as version {column_registry.version}')
+
+    DEBUG = DEBUG or args.debug
+    parquet = args.parquet and have_pyarrow()
+    if args.parquet and not parquet:
+        print(f'pyarrow is not installed, skipping the Parquet export to {PARQUET_DIR}')
+    features = args.features and have_numpy()
+    if args.features and not features:
+        print(f'numpy is not installed, skipping the feature matrix {FEATURE_MATRIX_FILE}')
+    INGEST_MODE = args.ingest
+    # A debug crawl replays fixtures, so it keeps saved_matches in memory and never opens (or first
+    # imports into) the real cache or raw archive
+    if not DEBUG or args.rebuild:
+        if INGEST_MODE == 'projected' and args.archive_raw:
+            raw_archive = RawArchive(RAW_ARCHIVE_FILE)
+        saved_matches = open_match_store(
+            match_store_path(args.store, INGEST_MODE),
+            backend=args.store,
+            import_from=match_store_sources(args.store, INGEST_MODE),
+            convert=cached_form,
+            # Only the roster's handles are indexed; the rest of the lobby would dwarf match_players
+            **({'indexed_handles': PLAYER_HANDLES} if args.store == 'sqlite' else {}),
+        )
+
+    if args.rebuild:
+        saved_matches.close()
+        if raw_archive is not None:
+            raw_archive.close()
+        store_path = match_store_path(args.store, INGEST_MODE)
+        export = Export(None, parquet, features)
+        match_ids = rebuild_csv(store_path, args.store, export.row_writer, args.workers)
+        export.exported_match_ids.update(match_ids)
+        save_export_manifest(export.close())
+        print(f'Rebuilt {DATA_FILE} from {len(match_ids)} cached matches in {store_path}')
+        return
+
+    # A debug run replays fixtures, so it neither retries the real failures nor records any
+    failed_matches = NegativeCache() if DEBUG else NegativeCache(
+        FAILED_MATCHES_FILE, ttl=FAILED_MATCH_RETRY_SECONDS, max_attempts=MAX_MATCH_LOOKUP_ATTEMPTS)
+
+    watermarks = {} if args.full_crawl or DEBUG else load_watermarks()
+    if DEBUG:
+        export = Export(None, parquet, features, DEBUG_EXPORT_DIR)
+    else:
+        export = Export(None if args.full_export else load_export_manifest(), parquet, features)
+    num_exported = len(export.exported_match_ids)
+    with nullcontext() if DEBUG else saved_matches:
+        new_watermarks = asyncio.run(crawl(export.row_writer, watermarks, export.exported_match_ids))
+    export_manifest = export.close()
+    print(f'Exported {len(export.exported_match_ids) - num_exported} new matches to '
+          f'{os.path.join(export.directory, DATA_FILE)}')
+
+    if raw_archive is not None:
+        raw_archive.close()
+
+    if not DEBUG:
+        save_watermarks({**watermarks, **new_watermarks})
+        save_export_manifest(export_manifest)
+        failed_matches.save()
+
+
+if __name__ == '__main__':
+    main()
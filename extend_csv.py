@@ -1,7 +1,87 @@
 import csv
+import json
+import os
+import sys
 
-with open('complete_data_file.csv', newline='') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        print(row)
-        break
+import numpy as np
+
+from column_registry import ColumnRegistry
+
+# Loads an export such as complete_data_file.csv as {column name: NumPy array}, typed by columns.json:
+# int64 and float64 columns (NaN for missing stats) and fixed-width unicode strings. Columns are matched by
+# header name, so files written before the column order was fixed load the same way; columns the registry
+# doesn't know load as strings. The first load parses the CSV in one pass and saves every column as .npy in
+# a sidecar directory next to it. Later loads memory-map those files instead, as long as the CSV's size and
+# mtime and the registry version still match.
+CSV_FILE = 'complete_data_file.csv'
+SIDECAR_SUFFIX = '.columns'
+SIDECAR_META = 'meta.json'
+NUMPY_DTYPES = {'int': np.int64, 'float': np.float64}
+NUMPY_CONVERTERS = {'int': int, 'float': float}
+
+
+def parse_column(values, column_type):
+    # `values` is the column's tuple of CSV fields, where an empty field is a missing value. An int column
+    # with missing values (placement, at times) loads as float64 with NaN like the float columns.
+    if column_type == 'str':
+        return np.array(values, dtype=str)
+    if '' in values:
+        return np.fromiter(map(float, [value or 'nan' for value in values]), np.float64, len(values))
+    return np.fromiter(map(NUMPY_CONVERTERS[column_type], values), NUMPY_DTYPES[column_type], len(values))
+
+
+def parse_csv(csv_path, registry):
+    with open(csv_path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+        columns = list(zip(*reader)) or [()] * len(header)
+    types = dict(zip(registry.names, registry.types))
+    return {name: parse_column(values, types.get(name, 'str')) for name, values in zip(header, columns)}
+
+
+def source_stamp(csv_path, registry):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'column_version': registry.version}
+
+
+def save_sidecar(sidecar_path, columns, stamp):
+    os.makedirs(sidecar_path, exist_ok=True)
+    for i, values in enumerate(columns.values()):
+        np.save(os.path.join(sidecar_path, f'{i:03d}.npy'), values)
+    # Written last, so a sidecar interrupted mid-save is never mistaken for a complete one
+    with open(os.path.join(sidecar_path, SIDECAR_META), 'w') as meta_file:
+        json.dump({'source': stamp, 'columns': list(columns)}, meta_file, indent=2)
+
+
+def load_sidecar(sidecar_path, stamp):
+    meta_path = os.path.join(sidecar_path, SIDECAR_META)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    if meta['source'] != stamp:
+        return None
+    return {
+        name: np.load(os.path.join(sidecar_path, f'{i:03d}.npy'), mmap_mode='r')
+        for i, name in enumerate(meta['columns'])
+    }
+
+
+def load_columns(csv_path=CSV_FILE, registry=None):
+    registry = registry or ColumnRegistry.load()
+    sidecar_path = csv_path + SIDECAR_SUFFIX
+    stamp = source_stamp(csv_path, registry)
+    columns = load_sidecar(sidecar_path, stamp)
+    if columns is None:
+        meta_path = os.path.join(sidecar_path, SIDECAR_META)
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        columns = parse_csv(csv_path, registry)
+        save_sidecar(sidecar_path, columns, stamp)
+    return columns
+
+
+if __name__ == '__main__':
+    columns = load_columns(sys.argv[1] if len(sys.argv) > 1 else CSV_FILE)
+    print(f'{len(next(iter(columns.values())))} rows, {len(columns)} columns')
+    print({name: values[0] for name, values in columns.items()})
@@ -0,0 +1,123 @@
+import os
+import struct
+from importlib.util import find_spec
+from operator import itemgetter
+
+# Dense float32 feature matrix of the export for modeling: the has_* roster flags and the stat columns, one
+# row per exported row, with missing stats as NaN. FEATURE_INDEX_FILE holds (match_id, player_name, unix
+# timestamp) for every row of the matrix. Both are plain .npy files that runs append to, so a job opens them
+# with numpy.load(path, mmap_mode='r') instead of parsing data_file.csv.
+FEATURE_MATRIX_FILE = 'features.npy'
+FEATURE_INDEX_FILE = 'features_index.npy'
+FEATURE_DTYPE = 'float32'
+FEATURE_INDEX_COLUMNS = ('match_id', 'player_name', 'match_unix_timestamp')
+FEATURE_INDEX_DTYPE = [('match_id', 'U24'), ('player_name', 'U40'), ('timestamp', 'float64')]
+FEATURE_BATCH_ROWS = 10000
+
+# A .npy header is magic, version, header length and a dict literal padded with spaces. Padding it to a
+# fixed size lets the shape be rewritten in place however many rows get appended.
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NPY_HEADER_SIZE = 256
+
+
+def have_numpy():
+    # numpy is only imported once a matrix is written, keeping it out of download.py's start-up
+    return find_spec('numpy') is not None
+
+
+def npy_header(descr, shape):
+    # `descr` is the dtype as .npy spells it, e.g. '<f4'
+    header = repr({'descr': descr, 'fortran_order': False, 'shape': shape})
+    header = header.encode('latin1').ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + b'\n'
+    assert len(header) == NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+    return NPY_MAGIC + struct.pack('<H', len(header)) + header
+
+
+def npy_rows(path):
+    # Rows in the header of the .npy file at `path`, None if there is no such file
+    if not os.path.exists(path):
+        return None
+    import numpy
+    with open(path, 'rb') as npy_file:
+        numpy.lib.format.read_magic(npy_file)
+        shape, _, _ = numpy.lib.format.read_array_header_1_0(npy_file)
+    return shape[0]
+
+
+class NpyAppender:
+    # .npy file opened for appending rows. Keeps the first `num_rows` rows already in the file and drops any
+    # after them; the header's shape is brought up to date on close().
+    def __init__(self, path, dtype, row_shape=(), num_rows=0):
+        import numpy
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.descr = numpy.lib.format.dtype_to_descr(self.dtype)
+        self.row_shape = tuple(row_shape)
+        self.num_rows = num_rows
+        row_bytes = self.dtype.itemsize
+        for size in self.row_shape:
+            row_bytes *= size
+        self.file = open(path, 'r+b' if num_rows else 'w+b')
+        self.file.truncate(NPY_HEADER_SIZE + num_rows * row_bytes)
+        self.write_header()
+        self.file.seek(0, os.SEEK_END)
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.descr, (self.num_rows,) + self.row_shape))
+
+    def append(self, rows):
+        assert rows.dtype == self.dtype and rows.shape[1:] == self.row_shape
+        self.file.write(rows.tobytes())
+        self.num_rows += len(rows)
+
+    def close(self):
+        self.write_header()
+        self.file.close()
+
+
+class FeatureMatrixWriter:
+    # Same write(row) interface as download.RowWriter, for rows with columns `names`. Rows are buffered
+    # and appended to both files every FEATURE_BATCH_ROWS.
+    def __init__(self, names, feature_names, num_rows=0, matrix_path=FEATURE_MATRIX_FILE,
+                 index_path=FEATURE_INDEX_FILE, batch_rows=FEATURE_BATCH_ROWS):
+        self.features_of = itemgetter(*[names.index(name) for name in feature_names])
+        self.index_of = itemgetter(*[names.index(name) for name in FEATURE_INDEX_COLUMNS])
+        self.matrix = NpyAppender(matrix_path, FEATURE_DTYPE, (len(feature_names),), num_rows)
+        self.index = NpyAppender(index_path, FEATURE_INDEX_DTYPE, (), num_rows)
+        self.batch_rows = batch_rows
+        self.features = []
+        self.index_rows = []
+
+    def write(self, row):
+        self.features.append(self.features_of(row))
+        self.index_rows.append(self.index_of(row))
+        if len(self.features) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.features:
+            return
+        import numpy
+        features = numpy.array(self.features, dtype=object)
+        features[numpy.equal(features, None)] = numpy.nan
+        self.matrix.append(features.astype(FEATURE_DTYPE))
+        self.index.append(numpy.array(self.index_rows, dtype=FEATURE_INDEX_DTYPE))
+        self.features = []
+        self.index_rows = []
+
+    def close(self):
+        # Returns the number of rows in the matrix
+        self.flush()
+        self.matrix.close()
+        self.index.close()
+        return self.matrix.num_rows
+
+
+def can_append_features(num_rows, matrix_path=FEATURE_MATRIX_FILE, index_path=FEATURE_INDEX_FILE):
+    # Whether both files still hold the `num_rows` rows an earlier run recorded
+    for path in (matrix_path, index_path):
+        rows = npy_rows(path)
+        if rows is None or rows < num_rows:
+            return False
+    return True
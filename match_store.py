@@ -0,0 +1,428 @@
+import io
+import json
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from records import participant_handles, unix_timestamp
+
+# Every record is <payload length><crc32 of payload> followed by the pickled match_id and then the pickled
+# match_json, so the index can be rebuilt without unpickling any payloads.
+RECORD_HEADER = struct.Struct('<II')
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+MAX_TRAINING_SAMPLES = 1000
+
+
+class MatchLogStore:
+    # Append-only, log-structured replacement for the pickled saved_matches dict.
+    # Writing a match appends one record, so the cost per match no longer grows with
+    # the size of the cache. The match_id -> offset index is rebuilt by scanning the
+    # log on open; a torn record left by a crash fails its length or checksum test
+    # and is cut off, leaving every earlier record intact. fsync is batched every
+    # `sync_every` appends and on close.
+    def __init__(self, path, sync_every=50):
+        self.path = path
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.index = {}
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self.file.seek(0)
+        offset = 0
+        while True:
+            header = self.file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = self.file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            match_id = pickle.loads(payload)
+            self.index[match_id] = (offset + RECORD_HEADER.size, length)
+            offset += RECORD_HEADER.size + length
+
+        if offset != self.file.seek(0, os.SEEK_END):
+            print(f'Dropping a torn record at the end of {self.path}')
+            self.file.truncate(offset)
+
+    def __contains__(self, match_id):
+        return match_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def keys(self):
+        return list(self.index)
+
+    def __getitem__(self, match_id):
+        offset, length = self.index[match_id]
+        with self.lock:
+            self.file.seek(offset)
+            payload = self.file.read(length)
+        payload_file = io.BytesIO(payload)
+        pickle.load(payload_file)
+        return pickle.load(payload_file)
+
+    def get(self, match_id, default=None):
+        if match_id not in self.index:
+            return default
+        return self[match_id]
+
+    def items(self):
+        for match_id in self.keys():
+            yield match_id, self[match_id]
+
+    def __setitem__(self, match_id, match_json):
+        payload = pickle.dumps(match_id, protocol=pickle.HIGHEST_PROTOCOL) \
+            + pickle.dumps(match_json, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.file.write(payload)
+            self.index[match_id] = (offset + RECORD_HEADER.size, len(payload))
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def update(self, matches):
+        for match_id, match_json in matches.items():
+            self[match_id] = match_json
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.sync()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RawArchive(MatchLogStore):
+    # Cold storage for the raw payloads that projected ingest leaves out of the match cache:
+    # the same append-only log, with every payload compressed on its own so any match can
+    # still be read back by id. With the optional zstandard package, payloads are compressed
+    # against a zstd dictionary, trained on the archive's payloads once it holds `train_after`
+    # of them (whichever runs wrote them); the stat metadata repeated in every segment then
+    # costs next to nothing. The dictionary is itself a record in the log, so an archive is
+    # always a single self-contained file.
+    # Payloads written before the dictionary exists are plain zstd, and without zstandard
+    # installed they fall back to zlib. All three can be read back side by side.
+    DICTIONARY_KEY = '__zstd_dictionary__'
+
+    def __init__(self, path, sync_every=50, train_after=64, dict_size=112 * 1024, level=10):
+        super().__init__(path, sync_every)
+        self.train_after = train_after
+        self.dict_size = dict_size
+        self.level = level
+        self.compression_dict = None
+        # Archive size at which to (re)try training; a failed attempt waits for the archive to double
+        self.train_at = train_after
+        if zstandard is not None and self.DICTIONARY_KEY in self.index:
+            dict_data = MatchLogStore.__getitem__(self, self.DICTIONARY_KEY)
+            self.compression_dict = zstandard.ZstdCompressionDict(dict_data)
+        self._make_codecs()
+
+    def _make_codecs(self):
+        if zstandard is None:
+            return
+        self.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.compression_dict)
+        self.decompressor = zstandard.ZstdDecompressor()
+        if self.compression_dict is not None:
+            self.dict_decompressor = zstandard.ZstdDecompressor(dict_data=self.compression_dict)
+
+    def train(self, samples):
+        try:
+            compression_dict = zstandard.train_dictionary(self.dict_size, samples)
+        except zstandard.ZstdError as e:
+            print(f'Could not train a dictionary for {self.path}: {e}')
+            return False
+        MatchLogStore.__setitem__(self, self.DICTIONARY_KEY, compression_dict.as_bytes())
+        self.compression_dict = compression_dict
+        self._make_codecs()
+        return True
+
+    def compress(self, raw):
+        if zstandard is None:
+            return zlib.compress(raw, 9)
+        if self.compression_dict is None and len(self) + 1 >= self.train_at:
+            # Trained on what the archive already holds, so payloads from earlier runs count towards it too
+            samples = [self.read_raw(match_id) for match_id in self.keys()[:MAX_TRAINING_SAMPLES - 1]]
+            if not self.train(samples + [raw]):
+                self.train_at = 2 * (len(self) + 1)
+        return self.compressor.compress(raw)
+
+    def decompress(self, data):
+        if data[:4] != ZSTD_MAGIC:
+            return zlib.decompress(data)
+        if zstandard is None:
+            raise ImportError(f'{self.path} holds zstd-compressed payloads; install the zstandard package to read them')
+        if zstandard.get_frame_parameters(data).dict_id:
+            return self.dict_decompressor.decompress(data)
+        return self.decompressor.decompress(data)
+
+    def keys(self):
+        return [match_id for match_id in self.index if match_id != self.DICTIONARY_KEY]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.index) - (self.DICTIONARY_KEY in self.index)
+
+    def read_raw(self, match_id):
+        return self.decompress(MatchLogStore.__getitem__(self, match_id))
+
+    def __getitem__(self, match_id):
+        return json.loads(self.read_raw(match_id))
+
+    def __setitem__(self, match_id, match_json):
+        super().__setitem__(match_id, self.compress(json.dumps(match_json, separators=(',', ':')).encode()))
+
+
+def compact_raw_archive(path, max_samples=MAX_TRAINING_SAMPLES):
+    # Retrains the archive's dictionary on (up to `max_samples` of) everything in it and rewrites every
+    # payload against it, e.g. once the archive has grown well past the matches its dictionary was first
+    # trained on. The rewritten archive only replaces the old one once it is complete.
+    if os.path.exists(path + '.new'):
+        os.remove(path + '.new')
+    with RawArchive(path) as archive, RawArchive(path + '.new') as compacted:
+        match_ids = archive.keys()
+        if zstandard is not None and match_ids:
+            compacted.train([archive.read_raw(match_id) for match_id in match_ids[:max_samples]])
+        for match_id in match_ids:
+            MatchLogStore.__setitem__(compacted, match_id, compacted.compress(archive.read_raw(match_id)))
+
+    os.replace(path + '.new', path)
+
+
+class SqliteMatchStore:
+    # SQLite-backed match cache. Payloads are only read when asked for, and the
+    # timestamp, modeId, mapId and participating-handle indexes let analysis code
+    # pull a slice of matches (see select()) without touching the rest. Writes are
+    # committed in batches of `sync_every` and on close.
+    def __init__(self, path, sync_every=50, indexed_handles=None):
+        self.path = path
+        self.sync_every = sync_every
+        self.unsynced = 0
+        # None indexes every participant; pass the roster to keep match_players small
+        self.indexed_handles = set(indexed_handles) if indexed_handles is not None else None
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS matches (
+                match_id TEXT PRIMARY KEY,
+                timestamp REAL,
+                mode_id TEXT,
+                map_id TEXT,
+                details BLOB
+            );
+            CREATE INDEX IF NOT EXISTS matches_timestamp ON matches (timestamp);
+            CREATE INDEX IF NOT EXISTS matches_mode_id ON matches (mode_id);
+            CREATE INDEX IF NOT EXISTS matches_map_id ON matches (map_id);
+            CREATE TABLE IF NOT EXISTS match_players (
+                handle TEXT NOT NULL,
+                match_id TEXT NOT NULL,
+                PRIMARY KEY (handle, match_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS match_players_match_id ON match_players (match_id);
+        ''')
+
+    def __contains__(self, match_id):
+        return self.db.execute('SELECT 1 FROM matches WHERE match_id = ?', (match_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [row[0] for row in self.db.execute('SELECT match_id FROM matches')]
+
+    def __getitem__(self, match_id):
+        row = self.db.execute('SELECT details FROM matches WHERE match_id = ?', (match_id,)).fetchone()
+        if row is None:
+            raise KeyError(match_id)
+        return pickle.loads(row[0]) if row[0] is not None else None
+
+    def get(self, match_id, default=None):
+        try:
+            return self[match_id]
+        except KeyError:
+            return default
+
+    def items(self):
+        for match_id, details in self.db.execute('SELECT match_id, details FROM matches'):
+            yield match_id, pickle.loads(details) if details is not None else None
+
+    def select(self, since=None, until=None, mode_id=None, map_id=None, handles=()):
+        # Yields (match_id, match_json) for matches in [since, until) unix time that match every filter
+        # and include all of `handles`
+        clauses, params = [], []
+        for clause, value in [('timestamp >= ?', since), ('timestamp < ?', until),
+                              ('mode_id = ?', mode_id), ('map_id = ?', map_id)]:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        for handle in handles:
+            clauses.append('match_id IN (SELECT match_id FROM match_players WHERE handle = ?)')
+            params.append(handle)
+        query = 'SELECT match_id, details FROM matches'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        for match_id, details in self.db.execute(query + ' ORDER BY timestamp', params):
+            yield match_id, pickle.loads(details) if details is not None else None
+
+    def __setitem__(self, match_id, match_json):
+        timestamp = mode_id = map_id = details = None
+        handles = set()
+        if match_json is not None:
+            data = match_json['data']
+            timestamp = unix_timestamp(data['metadata']['timestamp'])
+            mode_id = data['attributes']['modeId']
+            map_id = data['attributes']['mapId']
+            details = pickle.dumps(match_json, protocol=pickle.HIGHEST_PROTOCOL)
+            handles = participant_handles(match_json)
+            if self.indexed_handles is not None:
+                handles &= self.indexed_handles
+
+        self.db.execute('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?)',
+                        (match_id, timestamp, mode_id, map_id, details))
+        self.db.execute('DELETE FROM match_players WHERE match_id = ?', (match_id,))
+        self.db.executemany('INSERT INTO match_players VALUES (?, ?)', [(handle, match_id) for handle in handles])
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def update(self, matches):
+        for match_id, match_json in matches.items():
+            self[match_id] = match_json
+
+    def sync(self):
+        self.db.commit()
+        self.unsynced = 0
+
+    def close(self):
+        if self.db is None:
+            return
+        self.sync()
+        self.db.close()
+        self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+MATCH_STORE_BACKENDS = {
+    'log': MatchLogStore,
+    'sqlite': SqliteMatchStore,
+}
+
+
+def read_saved_matches(path):
+    # Yields (match_id, match_json) from any cache format this repo has used
+    if path.endswith('.p'):
+        with open(path, 'rb') as load_file:
+            yield from pickle.load(load_file).items()
+        return
+
+    backend = 'sqlite' if path.endswith('.sqlite') else 'log'
+    with MATCH_STORE_BACKENDS[backend](path) as store:
+        yield from store.items()
+
+
+def open_match_store(path, backend='log', import_from=(), convert=None, **options):
+    # The first open of a new store imports the first existing older cache in `import_from`,
+    # passing each (match_id, match_json) through `convert` when given
+    is_new = not os.path.exists(path)
+    store = MATCH_STORE_BACKENDS[backend](path, **options)
+    if is_new:
+        for source_path in import_from:
+            if os.path.exists(source_path):
+                print(f'Importing {source_path} into {path}...')
+                for match_id, match_json in read_saved_matches(source_path):
+                    # Older caches recorded failed lookups as None; those now live in a NegativeCache
+                    if match_json is not None:
+                        store[match_id] = convert(match_id, match_json) if convert else match_json
+                store.sync()
+                break
+    return store
+
+
+class NegativeCache:
+    # Failed match lookups, kept out of the match store so it only ever holds real
+    # payloads. A failure is skipped until its entry expires (the wait doubles with
+    # every failed attempt, starting at `ttl` seconds) and is then retried, until
+    # `max_attempts` lookups have failed and the match is given up on for good.
+    def __init__(self, path=None, ttl=24 * 60 * 60, max_attempts=5):
+        self.path = path
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as load_file:
+                self.entries = json.load(load_file)
+
+    def __contains__(self, match_id):
+        return match_id in self.entries
+
+    def should_skip(self, match_id, now=None):
+        entry = self.entries.get(match_id)
+        if entry is None:
+            return False
+        now = time.time() if now is None else now
+        return entry['attempts'] >= self.max_attempts or now < entry['retry_after']
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return [match_id for match_id, entry in self.entries.items()
+                if entry['attempts'] < self.max_attempts and now >= entry['retry_after']]
+
+    def record_failure(self, match_id, now=None):
+        now = time.time() if now is None else now
+        attempts = self.entries.get(match_id, {'attempts': 0})['attempts'] + 1
+        self.entries[match_id] = {
+            'attempts': attempts,
+            'retry_after': now + self.ttl * 2 ** (attempts - 1),
+        }
+
+    def record_success(self, match_id):
+        self.entries.pop(match_id, None)
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as save_file:
+            json.dump(self.entries, save_file, indent=2, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
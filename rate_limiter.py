@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class TokenBucket:
+    # Thread-safe token bucket shared by every caller of the tracker.gg API.
+    # Tokens refill continuously at `rate` per second up to `capacity`; a caller
+    # that finds the bucket empty reserves the next token (driving the balance
+    # negative) and sleeps until it would have been refilled, so waiters are
+    # served in arrival order without spinning. pause() also sets a deadline that
+    # every caller, including ones already sleeping on a reservation, waits out.
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = self.updated
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if wait > 0:
+                time.sleep(wait)
+            # A reservation made before a pause would otherwise go out during it; wait the pause out and
+            # queue up again, so callers resume at `rate` rather than all at once
+            paused = self.paused_until - time.monotonic()
+            if paused <= 0:
+                return
+            time.sleep(paused)
+
+    def pause(self, seconds):
+        # Hold every caller back until at least `seconds` from now, e.g. after the server asked us to slow
+        # down. Pauses requested together overlap rather than add up: the later deadline wins.
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
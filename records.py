@@ -0,0 +1,155 @@
+from datetime import datetime
+
+from dateutil.parser import parse
+
+# Compact typed views of tracker.gg payloads. A raw segment carries rank, percentile,
+# displayName, displayValue and friends for every stat; a SegmentRecord keeps only the
+# values the exporter reads, as one tuple aligned with the stat names it was decoded for.
+
+
+def unix_timestamp(timestamp):
+    # tracker.gg always sends strict ISO-8601 with an offset, which the stdlib decodes far faster than dateutil
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except ValueError:
+        return parse(timestr=timestamp).timestamp()
+
+
+class SegmentRecord:
+    __slots__ = ('player_name', 'handle', 'placement', 'team', 'stats')
+
+    def __init__(self, player_name, handle, placement, team, stats):
+        self.player_name = player_name
+        self.handle = handle
+        self.placement = placement
+        self.team = team
+        self.stats = stats
+
+    def __repr__(self):
+        return f'SegmentRecord({self.player_name!r}, placement={self.placement!r})'
+
+
+class MatchRecord:
+    __slots__ = ('match_id', 'timestamp', 'unix_timestamp', 'mode_id', 'map_id', 'duration', 'player_count',
+                 'team_count', 'map_name', 'segments')
+
+    def __init__(self, match_id, timestamp, unix_timestamp, mode_id, map_id, duration, player_count, team_count,
+                 map_name, segments):
+        self.match_id = match_id
+        self.timestamp = timestamp
+        self.unix_timestamp = unix_timestamp
+        self.mode_id = mode_id
+        self.map_id = map_id
+        self.duration = duration
+        self.player_count = player_count
+        self.team_count = team_count
+        self.map_name = map_name
+        self.segments = segments
+
+    def __repr__(self):
+        return f'MatchRecord({self.match_id!r}, {self.mode_id!r}, {len(self.segments)} segments)'
+
+
+MISSING_STAT = {'value': None}
+
+
+def decode_segment(seg, stat_names):
+    get_stat = seg['stats'].get
+    return SegmentRecord(
+        seg['attributes']['platformUserIdentifier'],
+        seg['metadata']['platformUserHandle'],
+        seg['metadata']['placement']['value'],
+        seg['attributes'].get('team'),
+        tuple([get_stat(stat_name, MISSING_STAT)['value'] for stat_name in stat_names]),
+    )
+
+
+def project_match(match_details):
+    # Slim form of a raw match details payload for the cache. 'data' keeps the attributes and the metadata
+    # fields the exporter reads, so it still works as a history entry. Each segment becomes
+    # (platformUserIdentifier, platformUserHandle, placement, team, {stat_id: value}), where a stat ID is the
+    # stat's position in the match's own 'stat_names' table. All stats are kept, only their display
+    # metadata (displayName, displayValue, rank, ...) is dropped.
+    data = match_details['data']
+    stat_ids = {}
+    segments = []
+    for seg in data['segments']:
+        stats = {}
+        for stat_name, stat in seg['stats'].items():
+            stats[stat_ids.setdefault(stat_name, len(stat_ids))] = stat['value']
+        segments.append((
+            seg['attributes']['platformUserIdentifier'],
+            seg['metadata']['platformUserHandle'],
+            seg['metadata']['placement']['value'],
+            seg['attributes'].get('team'),
+            stats,
+        ))
+
+    metadata = data['metadata']
+    return {
+        'data': {
+            'attributes': dict(data['attributes']),
+            'metadata': {
+                'timestamp': metadata['timestamp'],
+                'duration': {'value': metadata['duration']['value']},
+                'playerCount': metadata['playerCount'],
+                'teamCount': metadata['teamCount'],
+                'mapName': metadata['mapName'],
+                'modeName': metadata.get('modeName'),
+            },
+        },
+        'stat_names': list(stat_ids),
+        'segments': segments,
+    }
+
+
+def is_projected(match_details):
+    return 'stat_names' in match_details
+
+
+def participant_handles(match_details):
+    if is_projected(match_details):
+        return {seg[1] for seg in match_details['segments']}
+    return {seg['metadata']['platformUserHandle'] for seg in match_details['data']['segments']}
+
+
+def decode_projected_segments(match_details, stat_names, roster_handles):
+    stat_ids = {stat_name: stat_id for stat_id, stat_name in enumerate(match_details['stat_names'])}
+    wanted_ids = [stat_ids.get(stat_name) for stat_name in stat_names]
+    segments = match_details['segments']
+    if roster_handles is not None:
+        placements = {seg[2] for seg in segments if seg[1] in roster_handles}
+        segments = [seg for seg in segments if seg[2] in placements]
+    return [
+        SegmentRecord(player_name, handle, placement, team, tuple([stats.get(stat_id) for stat_id in wanted_ids]))
+        for player_name, handle, placement, team, stats in segments
+    ]
+
+
+def decode_match(match, match_details, stat_names, roster_handles=None):
+    # Match-level fields come from the history entry `match`; the lobby comes from its details, raw or projected.
+    # Both forms carry the same attributes and metadata under 'data', so match_details['data'] works as `match`.
+    # With `roster_handles`, only the teams (placements) containing one of those handles are decoded.
+    if is_projected(match_details):
+        segments = decode_projected_segments(match_details, stat_names, roster_handles)
+    else:
+        segments = match_details['data']['segments']
+        if roster_handles is not None:
+            placements = {seg['metadata']['placement']['value'] for seg in segments
+                          if seg['metadata']['platformUserHandle'] in roster_handles}
+            segments = [seg for seg in segments if seg['metadata']['placement']['value'] in placements]
+        segments = [decode_segment(seg, stat_names) for seg in segments]
+
+    timestamp = match['metadata']['timestamp']
+    return MatchRecord(
+        match['attributes']['id'],
+        timestamp,
+        unix_timestamp(timestamp),
+        match['attributes']['modeId'],
+        match['attributes']['mapId'],
+        match['metadata']['duration']['value'] / 1000,
+        match['metadata']['playerCount'],
+        match['metadata']['teamCount'],
+        match['metadata']['mapName'],
+        segments,
+    )
@@ -0,0 +1,154 @@
+import json
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+from feature_matrix import NPY_HEADER_SIZE, npy_header
+
+# Squad-composition index of the export. Every row carries a roster_mask, bit i being set when the i-th
+# roster handle (the i-th has_* column of columns.json) was on the row's team; the index maps each mask to
+# the ids of its rows, a row id being the row's position in data_file.csv and features.npy. Looking up the
+# rows where some players played together only visits the distinct masks, at most 2 ** len(handles) and
+# in practice a few dozen, and the rows it returns.
+#
+# ROSTER_INDEX_DIR holds one int64 .npy file of row ids per mask, which a run only appends its new rows to,
+# and ROSTER_INDEX_FILE with the handles and the row count of every mask file. Rows past a file's recorded
+# count, left by a run that didn't finish, are ignored and overwritten by the next save.
+ROSTER_INDEX_DIR = 'roster_index'
+INDEX_NAME = 'index.json'
+ROSTER_INDEX_FILE = os.path.join(ROSTER_INDEX_DIR, INDEX_NAME)
+ROW_ID_DESCR = '<i8' if sys.byteorder == 'little' else '>i8'
+
+
+def mask_path(directory, mask):
+    return os.path.join(directory, f'mask-{mask:05d}.npy')
+
+
+def read_row_ids(path, count):
+    row_ids = array('q')
+    with open(path, 'rb') as row_id_file:
+        row_id_file.seek(NPY_HEADER_SIZE)
+        row_ids.frombytes(row_id_file.read(count * row_ids.itemsize))
+    return row_ids
+
+
+def append_row_ids(path, count, row_ids):
+    # Keeps the first `count` row ids of the file at `path`, appends `row_ids` and updates the header
+    row_ids = array('q', row_ids)
+    with open(path, 'r+b' if count else 'w+b') as row_id_file:
+        row_id_file.truncate(NPY_HEADER_SIZE + count * row_ids.itemsize)
+        row_id_file.seek(0, os.SEEK_END)
+        row_id_file.write(row_ids.tobytes())
+        row_id_file.seek(0)
+        row_id_file.write(npy_header(ROW_ID_DESCR, (count + len(row_ids),)))
+
+
+class RosterIndex:
+    def __init__(self, handles, directory=ROSTER_INDEX_DIR, saved_rows=None, num_rows=0):
+        self.handles = list(handles)
+        self.bits = {handle: 1 << i for i, handle in enumerate(self.handles)}
+        self.directory = directory
+        # {mask: row ids in its file as of the last save}, {mask: row ids added since}
+        self.saved_rows = saved_rows if saved_rows is not None else {}
+        self.new_rows = {}
+        self.read_rows = {}
+        # Masks whose files truncate() cut short, to be trimmed on save
+        self.truncated = set()
+        self.num_rows = num_rows
+
+    @classmethod
+    def load(cls, directory=ROSTER_INDEX_DIR):
+        with open(os.path.join(directory, INDEX_NAME)) as index_file:
+            index = json.load(index_file)
+        saved_rows = {int(mask): count for mask, count in index['saved_rows'].items()}
+        return cls(index['handles'], directory, saved_rows, index['rows'])
+
+    def save(self):
+        # Only appends what was added since the last save, then records the new counts
+        os.makedirs(self.directory, exist_ok=True)
+        for mask in self.truncated.union(self.new_rows):
+            row_ids = self.new_rows.get(mask, [])
+            append_row_ids(mask_path(self.directory, mask), self.saved_rows.get(mask, 0), row_ids)
+            self.saved_rows[mask] = self.saved_rows.get(mask, 0) + len(row_ids)
+            self.read_rows.pop(mask, None)
+        self.new_rows = {}
+        self.truncated = set()
+
+        index = {
+            'handles': self.handles,
+            'rows': self.num_rows,
+            'saved_rows': {str(mask): count for mask, count in sorted(self.saved_rows.items())},
+        }
+        path = os.path.join(self.directory, INDEX_NAME)
+        with open(path + '.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(path + '.tmp', path)
+
+        # Files of masks a full export no longer has
+        kept = {os.path.basename(mask_path(self.directory, mask)) for mask in self.saved_rows}
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith('mask-') and file_name not in kept:
+                os.remove(os.path.join(self.directory, file_name))
+
+    def saved_row_ids(self, mask):
+        row_ids = self.read_rows.get(mask)
+        if row_ids is None:
+            row_ids = self.read_rows[mask] = read_row_ids(mask_path(self.directory, mask), self.saved_rows[mask])
+        return row_ids
+
+    def row_ids(self, mask):
+        row_ids = self.saved_row_ids(mask) if mask in self.saved_rows else array('q')
+        new_rows = self.new_rows.get(mask)
+        return row_ids + array('q', new_rows) if new_rows else row_ids
+
+    def truncate(self, num_rows):
+        # Forgets rows from `num_rows` on, e.g. ones a run that didn't finish added
+        if num_rows >= self.num_rows:
+            return
+        for mask in list(self.saved_rows):
+            count = bisect_left(self.saved_row_ids(mask), num_rows)
+            if count < self.saved_rows[mask]:
+                self.saved_rows[mask] = count
+                self.read_rows[mask] = self.read_rows[mask][:count]
+                self.truncated.add(mask)
+        for mask, row_ids in self.new_rows.items():
+            self.new_rows[mask] = [row_id for row_id in row_ids if row_id < num_rows]
+        self.num_rows = num_rows
+
+    def add(self, mask):
+        row_ids = self.new_rows.get(mask)
+        if row_ids is None:
+            row_ids = self.new_rows[mask] = []
+        row_ids.append(self.num_rows)
+        self.num_rows += 1
+
+    def masks(self):
+        return set(self.saved_rows).union(mask for mask, row_ids in self.new_rows.items() if row_ids)
+
+    def mask_of(self, handles):
+        mask = 0
+        for handle in handles:
+            mask |= self.bits[handle]
+        return mask
+
+    def rows_with(self, *handles):
+        # Ids, ascending, of the rows whose team had all of `handles` on it
+        wanted = self.mask_of(handles)
+        # Sorting the concatenated runs of ascending ids merges them in C, well ahead of heapq.merge
+        return sorted(chain.from_iterable(self.row_ids(mask) for mask in self.masks() if mask & wanted == wanted))
+
+    def rows_of_squad(self, *handles):
+        # Ids, ascending, of the rows whose team had exactly `handles` of the roster on it
+        return list(self.row_ids(self.mask_of(handles)))
+
+
+class RosterIndexWriter:
+    # Same write(row) interface as download.RowWriter; rows get consecutive ids starting at index.num_rows
+    def __init__(self, index, mask_position):
+        self.index = index
+        self.mask_position = mask_position
+
+    def write(self, row):
+        self.index.add(row[self.mask_position])
@@ -0,0 +1,81 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import constants
+import download
+from columnar_export import have_pyarrow
+from feature_matrix import have_numpy
+
+
+def match_rows(match_id):
+    details = constants.SPECIFIC_MATCH_SAMPLE
+    details = {'data': {**details['data'], 'attributes': {**details['data']['attributes'], 'id': match_id}}}
+    return list(download.match_rows(details['data'], details))
+
+
+def read_files(directory):
+    # {path: contents} of every file under `directory`
+    files = {}
+    for dir_path, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            with open(path, 'rb') as read_file:
+                files[path] = read_file.read()
+    return files
+
+
+class DebugExportTest(unittest.TestCase):
+    def setUp(self):
+        self.state = (download.DEBUG, download.saved_matches, download.failed_matches, download.raw_archive,
+                      download.INGEST_MODE)
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.parquet = have_pyarrow()
+        self.features = have_numpy()
+
+    def tearDown(self):
+        (download.DEBUG, download.saved_matches, download.failed_matches, download.raw_archive,
+         download.INGEST_MODE) = self.state
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def export(self, manifest, match_id):
+        export = download.Export(manifest, self.parquet, self.features)
+        for row in match_rows(match_id):
+            export.row_writer.write(row)
+        export.exported_match_ids.add(match_id)
+        download.save_export_manifest(export.close())
+
+    def export_files(self):
+        files = read_files('.')
+        return {path: contents for path, contents in files.items()
+                if not path.startswith(os.path.join('.', download.DEBUG_EXPORT_DIR))}
+
+    def test_debug_run_leaves_the_export_to_append_to(self):
+        self.export(None, '1000')
+        files = self.export_files()
+
+        # Neither the match cache nor the raw archive may be created either
+        download.main(['--debug'])
+        self.assertEqual(files, self.export_files())
+        download.main(['--debug', '--ingest', 'projected'])
+        self.assertEqual(files, self.export_files())
+        self.assertTrue(os.path.getsize(os.path.join(download.DEBUG_EXPORT_DIR, download.DATA_FILE)))
+
+        manifest = download.load_export_manifest()
+        self.assertTrue(download.Export.can_append(manifest, self.parquet, self.features))
+        self.export(manifest, '2000')
+        with open(download.DATA_FILE, newline='') as data_file:
+            rows = list(csv.reader(data_file))
+        match_ids = [row[rows[0].index('match_id')] for row in rows[1:]]
+        expected = ['1000'] * len(match_rows('1000')) + ['2000'] * len(match_rows('2000'))
+        self.assertEqual(expected, match_ids)
+        self.assertEqual(len(expected), download.load_export_manifest()['rows'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from feature_matrix import (FEATURE_INDEX_COLUMNS, NPY_HEADER_SIZE, FeatureMatrixWriter, NpyAppender,
+                            can_append_features, have_numpy, npy_rows)
+
+if have_numpy():
+    import numpy
+
+
+@unittest.skipUnless(have_numpy(), 'numpy is not installed')
+class NpyAppenderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'rows.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def append(self, num_rows, rows):
+        appender = NpyAppender(self.path, 'float32', (2,), num_rows)
+        appender.append(numpy.array(rows, dtype='float32'))
+        appender.close()
+
+    def test_appends_across_runs(self):
+        self.append(0, [[1, 2], [3, 4]])
+        self.append(2, [[5, 6]])
+        self.assertEqual([[1, 2], [3, 4], [5, 6]], numpy.load(self.path).tolist())
+
+    def test_drops_rows_past_num_rows(self):
+        self.append(0, [[1, 2], [3, 4]])
+        size = os.path.getsize(self.path)
+        # Rows an interrupted run appended, plus a torn one, past the 2 rows the manifest recorded
+        self.append(2, [[5, 6]])
+        with open(self.path, 'ab') as npy_file:
+            npy_file.write(b'\x00\x01\x02')
+
+        appender = NpyAppender(self.path, 'float32', (2,), 2)
+        appender.close()
+        self.assertEqual(size, os.path.getsize(self.path))
+        self.assertEqual(NPY_HEADER_SIZE + 2 * 2 * 4, size)
+        self.assertEqual([[1, 2], [3, 4]], numpy.load(self.path).tolist())
+        self.assertEqual(2, npy_rows(self.path))
+
+
+@unittest.skipUnless(have_numpy(), 'numpy is not installed')
+class FeatureMatrixWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.matrix_path = os.path.join(self.tmp_dir, 'features.npy')
+        self.index_path = os.path.join(self.tmp_dir, 'features_index.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, num_rows, rows):
+        names = list(FEATURE_INDEX_COLUMNS) + ['kills', 'deaths']
+        writer = FeatureMatrixWriter(names, ['kills', 'deaths'], num_rows, self.matrix_path, self.index_path)
+        for row in rows:
+            writer.write(row)
+        return writer.close()
+
+    def test_missing_stats_are_nan_and_truncation_keeps_both_files_aligned(self):
+        self.assertEqual(2, self.write(0, [('1', 'a', 1.0, 3.0, 1.0), ('1', 'b', 1.0, None, 2.0)]))
+        self.assertTrue(numpy.isnan(numpy.load(self.matrix_path)[1, 0]))
+        self.assertTrue(can_append_features(2, self.matrix_path, self.index_path))
+        self.assertFalse(can_append_features(3, self.matrix_path, self.index_path))
+
+        self.assertEqual(3, self.write(1, [('2', 'c', 2.0, 5.0, 0.0), ('2', 'd', 2.0, 6.0, 1.0)]))
+        matrix = numpy.load(self.matrix_path)
+        index = numpy.load(self.index_path)
+        self.assertEqual([3.0, 5.0, 6.0], matrix[:, 0].tolist())
+        self.assertEqual(['a', 'c', 'd'], index['player_name'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
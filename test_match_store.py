@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from match_store import MatchLogStore
+
+
+class MatchLogStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'saved_matches.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_matches(self, count):
+        with MatchLogStore(self.path) as store:
+            for i in range(count):
+                store[str(i)] = {'data': {'id': i}}
+        return os.path.getsize(self.path)
+
+    def test_torn_record_is_cut_off(self):
+        size = self.write_matches(5)
+        with open(self.path, 'ab') as log_file:
+            log_file.write(b'\x40\x00\x00\x00garbage')
+
+        with MatchLogStore(self.path) as store:
+            self.assertEqual(5, len(store))
+            self.assertEqual({'data': {'id': 4}}, store['4'])
+        self.assertEqual(size, os.path.getsize(self.path))
+
+    def test_corrupt_record_is_cut_off_with_everything_after_it(self):
+        size = self.write_matches(3)
+        with MatchLogStore(self.path) as store:
+            store['3'] = {'data': {'id': 3}}
+        # Flip the last byte of the fourth record's payload so its checksum no longer matches
+        with open(self.path, 'r+b') as log_file:
+            log_file.seek(-1, os.SEEK_END)
+            last = log_file.read(1)
+            log_file.seek(-1, os.SEEK_END)
+            log_file.write(bytes([last[0] ^ 0xff]))
+
+        with MatchLogStore(self.path) as store:
+            self.assertEqual(['0', '1', '2'], store.keys())
+        self.assertEqual(size, os.path.getsize(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
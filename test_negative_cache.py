@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from match_store import NegativeCache
+
+
+class NegativeCacheTest(unittest.TestCase):
+    def test_retries_after_a_doubling_wait(self):
+        cache = NegativeCache(ttl=100, max_attempts=3)
+        cache.record_failure('1', now=0)
+        self.assertTrue(cache.should_skip('1', now=99))
+        self.assertEqual([], cache.due(now=99))
+        self.assertFalse(cache.should_skip('1', now=100))
+        self.assertEqual(['1'], cache.due(now=100))
+
+        cache.record_failure('1', now=100)
+        self.assertTrue(cache.should_skip('1', now=299))
+        self.assertEqual(['1'], cache.due(now=300))
+
+    def test_gives_up_after_max_attempts(self):
+        cache = NegativeCache(ttl=100, max_attempts=2)
+        cache.record_failure('1', now=0)
+        cache.record_failure('1', now=100)
+        self.assertTrue(cache.should_skip('1', now=10 ** 9))
+        self.assertEqual([], cache.due(now=10 ** 9))
+
+    def test_success_forgets_the_failures(self):
+        cache = NegativeCache(ttl=100)
+        cache.record_failure('1', now=0)
+        cache.record_success('1')
+        self.assertNotIn('1', cache)
+        self.assertFalse(cache.should_skip('1', now=0))
+
+    def test_round_trips_through_its_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'failed_matches.json')
+            cache = NegativeCache(path, ttl=100)
+            cache.record_failure('1', now=0)
+            cache.save()
+            cache = NegativeCache(path, ttl=100)
+            self.assertTrue(cache.should_skip('1', now=50))
+            self.assertEqual(['1'], cache.due(now=100))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import threading
+import time
+import unittest
+
+from rate_limiter import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_pause_holds_back_reserved_callers(self):
+        # 8 callers at 3 requests/s: without the deadline, callers already sleeping on a reservation would
+        # still send during the pause
+        limiter = TokenBucket(3, 1)
+        start = time.monotonic()
+        sent = []
+        lock = threading.Lock()
+
+        def caller():
+            while time.monotonic() - start < 2.5:
+                limiter.acquire()
+                with lock:
+                    sent.append(time.monotonic() - start)
+
+        threads = [threading.Thread(target=caller) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        limiter.pause(1.5)
+        paused_at = time.monotonic() - start
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], [t for t in sent if paused_at < t < paused_at + 1.5])
+        self.assertTrue([t for t in sent if t >= paused_at + 1.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from roster_index import RosterIndex, mask_path
+
+HANDLES = ['a', 'b', 'c']
+
+
+class RosterIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp_dir, 'roster_index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, masks):
+        index = RosterIndex(HANDLES, self.directory)
+        for mask in masks:
+            index.add(mask)
+        index.save()
+
+    def test_appends_across_runs(self):
+        self.build([0b011, 0b001, 0b111])
+        index = RosterIndex.load(self.directory)
+        index.add(0b011)
+        index.save()
+
+        index = RosterIndex.load(self.directory)
+        self.assertEqual(4, index.num_rows)
+        self.assertEqual([0, 3], index.rows_of_squad('a', 'b'))
+        self.assertEqual([0, 2, 3], index.rows_with('a', 'b'))
+
+    def test_truncate_drops_rows_of_an_unfinished_run(self):
+        self.build([0b011, 0b001, 0b111])
+        size = os.path.getsize(mask_path(self.directory, 0b011))
+        # A run that added rows and saved the index but not the export manifest, which still says 3 rows
+        index = RosterIndex.load(self.directory)
+        for mask in [0b011, 0b100]:
+            index.add(mask)
+        index.save()
+
+        index = RosterIndex.load(self.directory)
+        index.truncate(3)
+        index.add(0b010)
+        index.save()
+
+        index = RosterIndex.load(self.directory)
+        self.assertEqual(4, index.num_rows)
+        self.assertEqual([0], index.rows_of_squad('a', 'b'))
+        self.assertEqual([], index.rows_of_squad('c'))
+        self.assertEqual([3], index.rows_of_squad('b'))
+        self.assertEqual(size, os.path.getsize(mask_path(self.directory, 0b011)))
+
+    def test_unsaved_tail_of_a_mask_file_is_ignored(self):
+        self.build([0b001, 0b001])
+        with open(mask_path(self.directory, 0b001), 'ab') as row_id_file:
+            row_id_file.write(b'\x07' * 8)
+
+        index = RosterIndex.load(self.directory)
+        self.assertEqual([0, 1], index.rows_of_squad('a'))
+        index.add(0b001)
+        index.save()
+        self.assertEqual([0, 1, 2], RosterIndex.load(self.directory).rows_of_squad('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()